@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Array-backed MCTS tree: the same search as mcts.mcts_search, with the nodes stored as
+a struct of numpy arrays instead of TreeHorn objects.
+
+Node i is row i of each array.  The children of a node are created together, so they are
+rows first_child[i] to first_child[i] + n_children[i], and best_child is an argmax
+(or softmax) over a slice.
+The cube state of a node is kept packed in 27 bytes, as cube.state_key.
+
+59 bytes per node (plus the spare rows while the arrays grow), against about 565 for a TreeHorn
+with its Cube (see mcts.NODE_BYTES).
+No transposition table: the tree stays a tree.
+"""
+
+#%% Packages
+import numpy as np
+from cube import Cube, VALID_ROTATES, ROTATE_TABLE, SUCCESSOR_CODES, get_reward
+import mcts
+
+#%% Tables
+
+def _build_next_codes() :
+    """
+    NEXT_CODES[last] are the SUCCESSOR_CODES of rotation code last, padded to 15 columns 
+    by repeating the first code, so the rollout of all children is 1 gather 
+    (a repeated state does not change the max reward).
+    """
+    codes = SUCCESSOR_CODES[:len(VALID_ROTATES)]
+    width = max(len(c) for c in codes)
+    return np.array([np.resize(c, width) for c in codes])
+
+NEXT_CODES = _build_next_codes()
+NO_ACTION = len(VALID_ROTATES) # action code of the root
+
+def pack_states(states) :
+    # (N, 54) states -> (N, 27), the same bytes as cube.state_key
+    states = np.asarray(states, dtype=np.uint8).reshape(-1, 54)
+    return states[:, :27] * 6 + states[:, 27:]
+
+def unpack_states(keys) :
+    # (N, 27) state keys -> (N, 54) states
+    return np.concatenate([keys // 6, keys % 6], axis=1)
+
+#%% Tree
+
+class ArrayTree :
+    """
+    Search tree with 1 row per node in preallocated arrays, grown by at least chunk rows at a time.
+        keys: (N, 27) uint8 state key
+        parent: index of the parent node, -1 for the root
+        action: rotation code from the parent (NO_ACTION for the root)
+        depth: rotations from the root
+        reward, best_reward: as TreeHorn
+        num_visits: as TreeHorn
+        first_child, n_children: the slice of children, first_child is -1 until expanded
+    """
+
+    def __init__(self, cube : Cube, chunk=1<<16) :
+        self.chunk = chunk
+        self.size = 0
+        self.capacity = 0
+        self.max_depth = 1
+        self.moves = list(cube.moves)
+        self.keys = np.zeros((0, 27), dtype=np.uint8)
+        self.parent = np.zeros(0, dtype=np.int32)
+        self.action = np.zeros(0, dtype=np.int8)
+        self.depth = np.zeros(0, dtype=np.int16)
+        self.reward = np.zeros(0, dtype=np.float64)
+        self.best_reward = np.zeros(0, dtype=np.float64)
+        self.num_visits = np.zeros(0, dtype=np.int32)
+        self.first_child = np.zeros(0, dtype=np.int32)
+        self.n_children = np.zeros(0, dtype=np.int8)
+        state = cube.cube.reshape(1, 54)
+        self.add_nodes(-1, np.array([NO_ACTION]), state, np.array([cube.get_reward()]))
+
+    def __len__(self) :
+        return self.size
+
+    def __repr__(self) :
+        # same as repr of a TreeHorn root: [solved, nodes not counting the root, max depth, best reward]
+        r = self.best_reward[0]
+        return f'[{r == 1},{self.size - 1},{self.max_depth},{r:.3f}]'
+
+    def nbytes(self) :
+        return sum(a.nbytes for a in (self.keys, self.parent, self.action, self.depth, self.reward,
+                                      self.best_reward, self.num_visits, self.first_child, self.n_children))
+
+    def grow(self, n) :
+        # make room for n more nodes
+        if self.size + n <= self.capacity :
+            return
+        self.capacity = self.size + n + max(self.chunk, self.capacity // 2)
+        for name in ('keys', 'parent', 'action', 'depth', 'reward', 'best_reward',
+                     'num_visits', 'first_child', 'n_children') :
+            old = getattr(self, name)
+            new = np.zeros((self.capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def add_nodes(self, parent, actions, states, rewards) :
+        # append the children of parent, returns the index of the first one
+        n = len(actions)
+        self.grow(n)
+        i = self.size
+        self.keys[i:i+n] = pack_states(states)
+        self.parent[i:i+n] = parent
+        self.action[i:i+n] = actions
+        self.depth[i:i+n] = self.depth[parent] + 1 if parent >= 0 else 0
+        self.reward[i:i+n] = rewards
+        self.best_reward[i:i+n] = rewards
+        self.num_visits[i:i+n] = 1
+        self.first_child[i:i+n] = -1
+        self.n_children[i:i+n] = 0
+        self.size += n
+        self.max_depth = max(self.max_depth, int(self.depth[i]) + 1)
+        return i
+
+    def state(self, i) :
+        return unpack_states(self.keys[i:i+1])[0]
+
+    def children(self, i) :
+        f = self.first_child[i]
+        return range(f, f + self.n_children[i]) if f >= 0 else range(0)
+
+    def get_moves(self, i) :
+        """
+        All moves from the root state to node i, including the moves that made the root state.
+        """
+        path = []
+        while self.parent[i] >= 0 :
+            path.append(VALID_ROTATES[self.action[i]])
+            i = self.parent[i]
+        return self.moves + path[::-1]
+
+    def best_child(self, i, explore_param=0.0) :
+        f = self.first_child[i]
+        if f < 0 :
+            raise Exception("Attempt to find best child of unexpanded node")
+        child_rewards = self.best_reward[f:f + self.n_children[i]]
+        if explore_param == 0 :
+            return f + int(np.argmax(child_rewards))
+        weights = mcts.softmax(child_rewards, theta=explore_param)
+        return f + np.random.choice(len(child_rewards), p=weights)
+
+    def tree_policy(self, explore_param) :
+        """
+        Go down from the root with best_child to a node that is not expanded, and expand it.
+        Returns the path of node indices from the root.
+        """
+        path = [0]
+        while self.first_child[path[-1]] >= 0 :
+            path.append(self.best_child(path[-1], explore_param))
+        self.expand(path[-1])
+        return path
+
+    def expand(self, i) :
+        state = self.state(i)
+        if (self.reward[i] == 1) :
+            raise Exception("Attempt to expand a solved cube")
+        codes = SUCCESSOR_CODES[self.action[i]]
+        states = state[ROTATE_TABLE[codes]]
+        self.first_child[i] = self.add_nodes(i, codes, states, get_reward(states))
+        self.n_children[i] = len(codes)
+
+    def rollout(self, i, pool) :
+        """
+        As mcts.rollout: score every child's children in 1 request,
+        and return the reward of the best child.
+        """
+        kids = slice(self.first_child[i], self.first_child[i] + self.n_children[i])
+        states = unpack_states(self.keys[kids])
+        perms = ROTATE_TABLE[NEXT_CODES[self.action[kids]]] # (kids, 15, 54)
+        leaves = states[np.arange(len(states))[:, None, None], perms]
+        rewards = pool.map_rewards(leaves.reshape(-1, 54)).reshape(len(states), -1)
+        np.maximum(self.best_reward[kids], rewards.max(axis=1), out=self.best_reward[kids])
+        return self.reward[self.best_child(i)]
+
+    def backpropagate(self, path, reward) :
+        # as mcts.backpropagate, on a tree
+        self.num_visits[path] += 1
+        i = path[-1]
+        reward = max(reward, self.best_reward[i])
+        self.best_reward[i] = reward
+        i = self.parent[i]
+        while i >= 0 and self.best_reward[i] < reward :
+            self.best_reward[i] = reward
+            i = self.parent[i]
+
+    def search(self, iterations=100, explore_param=0.05, pool=None) :
+        """
+        As mcts.mcts_search.  Returns True if solved.
+        """
+        if pool is None :
+            with mcts.SolverPool() as pool :
+                return self.search(iterations, explore_param, pool)
+        for _ in range(iterations) :
+            path = self.tree_policy(explore_param)
+            reward = self.rollout(path[-1], pool)
+            self.backpropagate(path, reward)
+            if self.best_reward[0] == 1 :
+                break
+        return bool(self.best_reward[0] == 1)
+
+    def solution(self) :
+        """
+        Rotations from the root to the best node, following best_child from the root.
+        """
+        i = 0
+        moves = []
+        while self.first_child[i] >= 0 :
+            i = self.best_child(i)
+            moves.append(VALID_ROTATES[self.action[i]])
+        return moves
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the cube and search hot paths, with fixed seeds so runs can be compared.
+
+Micro: time per call of Cube.rotate for each rotation, each entropy style, get_reward
+    (1 cube and a batch), get_possible_actions, TreeHorn.expand and best_child.
+    Each is the best of several repeats, to take out most of the machine noise.
+Macro: mcts_search iterations and nodes per second on a deep scramble, and time to solve
+    by scramble depth.
+
+Save a run as a baseline and compare later runs with it:
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json
+A result more than --threshold slower than the baseline is reported as a regression,
+and the exit code is 1.
+"""
+
+#%% Packages
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+from cube import Cube, VALID_ROTATES, get_reward
+import mcts
+
+#%% Timing
+
+def time_calls(fn, setup=None, min_time=0.2, repeat=5) :
+    """
+    Seconds per call of fn, the best of repeat runs of at least min_time each.
+    With setup, each call is fn(setup()) and only fn is timed (for calls that change their input).
+    """
+    best = np.inf
+    for _ in range(repeat) :
+        calls = 0
+        elapsed = 0.0
+        if setup is None :
+            number = 1
+            while elapsed < min_time :
+                tic = time.perf_counter()
+                for _ in range(number) :
+                    fn()
+                elapsed = time.perf_counter() - tic
+                calls = number
+                number *= 2
+        else :
+            while elapsed < min_time :
+                arg = setup()
+                tic = time.perf_counter()
+                fn(arg)
+                elapsed += time.perf_counter() - tic
+                calls += 1
+        best = min(best, elapsed / calls)
+    return best
+
+def scrambled_cube(depth, seed) :
+    np.random.seed(seed)
+    rubiks = Cube()
+    rubiks.move(rubiks.rand_move(depth))
+    rubiks.moves = []
+    return rubiks
+
+#%% Micro benchmarks
+
+def micro_benchmarks(seed=0, min_time=0.2, repeat=5, name_filter=None) :
+    """
+    Returns {name : seconds per call}.
+    """
+    # each case has its own copy of the seeded cube, so no case sees the changes of another
+    cases = {}
+
+    def rotate(r) :
+        rubiks = scrambled_cube(20, seed)
+        def fn() :
+            rubiks.rotate(r)
+            rubiks.moves.clear()
+        return fn
+    for r in VALID_ROTATES :
+        cases[f'rotate_{r}'] = (rotate(r), None)
+    for style in ('naive', 'align', 'matrix') :
+        cases[f'entropy_{style}'] = (lambda style=style, rubiks=scrambled_cube(20, seed) : rubiks.update_entropy(style), None)
+    cases['get_reward'] = (scrambled_cube(20, seed).get_reward, None)
+    states = np.array([scrambled_cube(20, seed + i).cube.reshape(54) for i in range(1000)])
+    cases['get_reward_batch_1000'] = ((lambda : get_reward(states)), None)
+    cases['get_possible_actions'] = (lambda rubiks=scrambled_cube(20, seed) : rubiks.get_possible_actions('R1'), None)
+    cases['treehorn_expand'] = ((lambda node : node.expand()), (lambda : mcts.TreeHorn(scrambled_cube(20, seed))))
+    root = mcts.TreeHorn(scrambled_cube(20, seed))
+    root.expand()
+    cases['best_child_argmax'] = ((lambda : mcts.best_child(root, 0.0)), None)
+    cases['best_child_softmax'] = ((lambda : mcts.best_child(root, 0.05)), None)
+
+    results = {}
+    for name, (fn, setup) in cases.items() :
+        if name_filter is not None and name_filter not in name :
+            continue
+        np.random.seed(seed)
+        results[name] = time_calls(fn, setup, min_time, repeat)
+    return results
+
+#%% Macro benchmarks
+
+def macro_benchmarks(seed=0, n_workers=8, iterations=300, solve_depths=range(4,8+1), samples=3,
+                     solve_iterations=3000, name_filter=None) :
+    """
+    Returns {name : value}: mcts_search iterations/s and nodes/s on a 20 rotation scramble,
+    and for each scramble depth the mean seconds to solve and the success rate.
+    """
+    results = {}
+    with mcts.SolverPool(n_workers=n_workers) as pool :
+        names = ('mcts_search_iterations_per_s', 'mcts_search_nodes_per_s')
+        if name_filter is None or any(name_filter in name for name in names) :
+            np.random.seed(seed)
+            root = mcts.TreeHorn(scrambled_cube(20, seed))
+            result = mcts.mcts_search(root, iterations=iterations, pool=pool)
+            results['mcts_search_iterations_per_s'] = result.iterations / result.elapsed
+            results['mcts_search_nodes_per_s'] = result.nodes / result.elapsed
+        for depth in solve_depths :
+            name = f'solve_depth_{depth}'
+            if name_filter is not None and not any(name_filter in n for n in (name + '_s', name + '_success')) :
+                continue
+            elapsed = []
+            solved = 0
+            for n in range(samples) :
+                np.random.seed(seed + n)
+                root = mcts.TreeHorn(scrambled_cube(depth, seed + n))
+                result = mcts.mcts_search(root, iterations=solve_iterations, pool=pool)
+                elapsed.append(result.elapsed)
+                solved += result.solved
+            results[name + '_s'] = float(np.mean(elapsed))
+            results[name + '_success'] = solved / samples
+    return results
+
+#%% Baselines and report
+
+# units, and which direction is better, from the end of the name
+UNITS = (('_per_s', 'per s', True), ('_success', 'rate', True), ('_s', 's', False), ('', 's/call', False))
+
+def unit(name) :
+    for suffix, label, higher_is_better in UNITS :
+        if name.endswith(suffix) :
+            return label, higher_is_better
+
+def git_commit() :
+    try :
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError :
+        return None
+
+def run_info(seed) :
+    return {'time' : time.strftime('%Y-%m-%d %H:%M:%S'), 'commit' : git_commit(), 'seed' : seed,
+            'python' : platform.python_version(), 'numpy' : np.__version__, 'machine' : platform.platform()}
+
+def compare(results, baseline, threshold=0.1) :
+    """
+    Print each result against the baseline.  Returns the names of the regressions:
+    more than threshold (a fraction) worse than the baseline.
+    """
+    regressions = []
+    print(f"{'benchmark':32} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, value in results.items() :
+        label, higher_is_better = unit(name)
+        base = baseline.get(name)
+        if base is None :
+            print(f'{name:32} {"":>12} {value:12.4g} {"new":>8}  {label}')
+            continue
+        change = (value - base) / base if base else 0.0
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > threshold :
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif worse < -threshold :
+            flag = 'improved'
+        print(f'{name:32} {base:12.4g} {value:12.4g} {change:+8.1%}  {label} {flag}')
+    return regressions
+
+#%% Main
+
+def main() :
+    parser = argparse.ArgumentParser(description='Cube and search benchmarks')
+    parser.add_argument('--suite', choices=('micro', 'macro', 'all'), default='all')
+    parser.add_argument('--filter', default=None, help='only run benchmarks with this in their name')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per repeat of a micro benchmark')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=8, help='rollout workers for the macro benchmarks')
+    parser.add_argument('--samples', type=int, default=3, help='cubes per scramble depth')
+    parser.add_argument('--save', default=None, help='save the results as a JSON baseline')
+    parser.add_argument('--compare', default=None, help='JSON baseline to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='fraction worse that counts as a regression')
+    args = parser.parse_args()
+
+    results = {}
+    if args.suite in ('micro', 'all') :
+        results.update(micro_benchmarks(args.seed, args.min_time, args.repeat, args.filter))
+    if args.suite in ('macro', 'all') :
+        results.update(macro_benchmarks(args.seed, args.workers, samples=args.samples, name_filter=args.filter))
+
+    baseline = {}
+    if args.compare is not None :
+        with open(args.compare) as f :
+            saved = json.load(f)
+        print(f"Baseline: {saved['info']['time']}, commit {saved['info']['commit']}")
+        baseline = saved['results']
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.save is not None :
+        with open(args.save, 'w') as f :
+            json.dump({'info' : run_info(args.seed), 'results' : results}, f, indent=1)
+    if regressions :
+        print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == '__main__'  :
+    sys.exit(main())
@@ -3,6 +3,343 @@
 import matplotlib.pyplot as plt
 from matplotlib import colors
 import numpy as np
+import math
+import itertools
+
+VALID_ROTATES = ('R1', 'R2', 'R3', 'L1', 'L2', 'L3', \
+                 'U1', 'U2', 'U3', 'D1', 'D2', 'D3', \
+                 'F1', 'F2', 'F3', 'B1', 'B2', 'B3')
+
+def _slice_rotate(cube, r) :
+    """
+    Reference implementation of a rotation on a 6x3x3 array, in place, with numpy slices.
+    Only used to build the permutation tables, and to check them.
+    """
+    def rotate_face(f) :
+            save = np.copy(cube[f,0,:])
+            cube[f,0,:] = np.flip(cube[f,:,0])
+            cube[f,:,0] = cube[f,2,:]
+            cube[f,2,:] = np.flip(cube[f,:,2])
+            cube[f,:,2] = save
+
+    for _ in range(int(r[1])) :
+        match r[0] :
+            case 'R' :
+                rotate_face(3)
+                save = np.copy(cube[0,:,2])
+                cube[0,:,2] = cube[2,:,2]
+                cube[2,:,2] = cube[5,:,2]
+                cube[5,:,2] = np.flip(cube[4,:,0])
+                cube[4,:,0] = np.flip(save)
+            case 'L' :
+                rotate_face(1)
+                save = np.copy(cube[0,:,0])
+                cube[0,:,0] = np.flip(cube[4,:,2])
+                cube[4,:,2] = np.flip(cube[5,:,0])
+                cube[5,:,0] = cube[2,:,0]
+                cube[2,:,0] = save
+            case 'U' :
+                rotate_face(0)
+                save = np.copy(cube[1,0,:])
+                cube[1,0,:] = cube[2,0,:]
+                cube[2,0,:] = cube[3,0,:]
+                cube[3,0,:] = cube[4,0,:]
+                cube[4,0,:] = save
+            case 'D' :
+                rotate_face(5)
+                save = np.copy(cube[2,2,:])
+                cube[2,2,:] = cube[1,2,:]
+                cube[1,2,:] = cube[4,2,:]
+                cube[4,2,:] = cube[3,2,:]
+                cube[3,2,:] = save
+            case 'F' :
+                rotate_face(2)
+                save = np.copy(cube[0,2,:])
+                cube[0,2,:] = np.flip(cube[1,:,2])
+                cube[1,:,2] = cube[5,0,:]
+                cube[5,0,:] = np.flip(cube[3,:,0])
+                cube[3,:,0] = save
+            case 'B' :
+                rotate_face(4)
+                save = np.copy(cube[0,0,:])
+                cube[0,0,:] = cube[3,:,2]
+                cube[3,:,2] = np.flip(cube[5,2,:])
+                cube[5,2,:] = cube[1,:,0]
+                cube[1,:,0] = np.flip(save)
+    return cube
+
+def _build_rotate_table() :
+    # Apply each rotation to the facelet indices: the result says where every facelet comes from.
+    # i.e. new_cube.flat[i] = cube.flat[perm[i]]
+    table = np.zeros((len(VALID_ROTATES), 54), dtype=np.intp)
+    for i, r in enumerate(VALID_ROTATES) :
+        table[i] = _slice_rotate(np.arange(54).reshape(6,3,3), r).flatten()
+    return table
+
+# Alignment entropy.
+# Facelets of each corner, edge and centre as (face, row, col) of Cube.cube
+ALIGN_PIECES = {
+    'UFL' : ((0,2,0), (2,0,0), (1,0,2)),
+    'URF' : ((0,2,2), (3,0,0), (2,0,2)),
+    'ULB' : ((0,0,0), (1,0,0), (4,0,2)),
+    'UBR' : ((0,0,2), (4,0,0), (3,0,2)),
+    'DLF' : ((5,0,0), (1,2,2), (2,2,0)),
+    'DFR' : ((5,0,2), (2,2,2), (3,2,0)),
+    'DLB' : ((5,2,0), (1,2,0), (4,2,2)),
+    'DBR' : ((5,2,2), (4,2,0), (3,2,2)),
+    'UF' : ((0,2,1), (2,0,1)),
+    'UL' : ((0,1,0), (1,0,1)),
+    'UB' : ((0,0,1), (4,0,1)),
+    'UR' : ((0,1,2), (3,0,1)),
+    'LF' : ((1,1,2), (2,1,0)),
+    'LB' : ((1,1,0), (4,1,2)),
+    'RF' : ((3,1,0), (2,1,2)),
+    'BR' : ((4,1,0), (3,1,2)),
+    'DF' : ((5,0,1), (2,2,1)),
+    'DL' : ((5,1,0), (1,2,1)),
+    'DB' : ((5,2,1), (4,2,1)),
+    'DR' : ((5,1,2), (3,2,1)),
+    'U' : ((0,1,1),),
+    'L' : ((1,1,1),),
+    'F' : ((2,1,1),),
+    'R' : ((3,1,1),),
+    'B' : ((4,1,1),),
+    'D' : ((5,1,1),),
+    }
+
+# Each corner should align with its 3 edges, and with 2 centres.
+# A check is 2 pairs of facelets that must both match: ((piece, i), (piece, j)), ((piece, k), (piece, l))
+ALIGN_CHECKS = [
+    # UFL should align with UF, LF, UL, and U, F
+    ((('UFL',0), ('UF',0)), (('UFL',1), ('UF',1))),
+    ((('UFL',2), ('LF',0)), (('UFL',1), ('LF',1))),
+    ((('UFL',0), ('UL',0)), (('UFL',2), ('UL',1))),
+    ((('UFL',0), ('U',0)), (('UFL',1), ('F',0))),
+    # URF should align with UR, RF, UF, and U, R
+    ((('URF',0), ('UR',0)), (('URF',1), ('UR',1))),
+    ((('URF',1), ('RF',0)), (('URF',2), ('RF',1))),
+    ((('URF',0), ('UF',0)), (('URF',2), ('UF',1))),
+    ((('URF',0), ('U',0)), (('URF',1), ('R',0))),
+    # ULB should align with UL, LB, UB, and U, L
+    ((('ULB',0), ('UL',0)), (('ULB',1), ('UL',1))),
+    ((('ULB',1), ('LB',0)), (('ULB',2), ('LB',1))),
+    ((('ULB',0), ('UB',0)), (('ULB',2), ('UB',1))),
+    ((('ULB',0), ('U',0)), (('ULB',1), ('L',0))),
+    # UBR should align with UB, BR, UR, and U, B
+    ((('UBR',0), ('UB',0)), (('UBR',1), ('UB',1))),
+    ((('UBR',1), ('BR',0)), (('UBR',2), ('BR',1))),
+    ((('UBR',0), ('UR',0)), (('UBR',2), ('UR',1))),
+    ((('UBR',0), ('U',0)), (('UBR',1), ('B',0))),
+    # DLF should align with DL, LF, DF, and D, L
+    ((('DLF',0), ('DL',0)), (('DLF',1), ('DL',1))),
+    ((('DLF',1), ('LF',0)), (('DLF',2), ('LF',1))),
+    ((('DLF',0), ('DF',0)), (('DLF',2), ('DF',1))),
+    ((('DLF',0), ('D',0)), (('DLF',1), ('L',0))),
+    # DFR should align with DF, RF, DR, and D, F
+    ((('DFR',0), ('DF',0)), (('DFR',1), ('DF',1))),
+    ((('DFR',1), ('RF',1)), (('DFR',2), ('RF',0))),
+    ((('DFR',0), ('DR',0)), (('DFR',2), ('DR',1))),
+    ((('DFR',0), ('D',0)), (('DFR',1), ('F',0))),
+    # DLB should align with DL, LB, DB, and D, L
+    ((('DLB',0), ('DL',0)), (('DLB',1), ('DL',1))),
+    ((('DLB',1), ('LB',0)), (('DLB',2), ('LB',1))),
+    ((('DLB',0), ('DB',0)), (('DLB',2), ('DB',1))),
+    ((('DLB',0), ('D',0)), (('DLB',1), ('L',0))),
+    # DBR should align with DB, BR, DR, and D, B
+    ((('DBR',0), ('DB',0)), (('DBR',1), ('DB',1))),
+    ((('DBR',1), ('BR',0)), (('DBR',2), ('BR',1))),
+    ((('DBR',0), ('DR',0)), (('DBR',2), ('DR',1))),
+    ((('DBR',0), ('D',0)), (('DBR',1), ('B',0))),
+    ]
+
+def _build_align_index() :
+    # 4 rows of flat facelet indices: check k passes if s[A[k]]==s[B[k]] and s[C[k]]==s[D[k]]
+    def flat(piece, i) :
+        f, r, c = ALIGN_PIECES[piece][i]
+        return f*9 + r*3 + c
+    return np.array([[flat(*a), flat(*b), flat(*c), flat(*d)] for ((a, b), (c, d)) in ALIGN_CHECKS]).T
+
+ALIGN_INDEX = _build_align_index()
+MAX_ALIGN_ENTROPY = len(ALIGN_CHECKS)
+
+def align_entropy(states) :
+    """
+    Alignment entropy of 1 flat state (54,) or a batch (N, 54), with the checks in ALIGN_CHECKS.
+    range: 8 - 32
+    """
+    A, B, C, D = ALIGN_INDEX
+    if states.ndim == 1 :
+        return MAX_ALIGN_ENTROPY - np.count_nonzero((states[A] == states[B]) & (states[C] == states[D]))
+    align = ((states[:, A] == states[:, B]) & (states[:, C] == states[:, D])).sum(axis=1)
+    return MAX_ALIGN_ENTROPY - align
+
+def state_key(states) :
+    """
+    Compact hashable key for 1 state (54 or 6x3x3): 2 facelets per byte, 27 bytes.
+    For a batch (N, 54) returns a list of N keys.
+    """
+    states = np.asarray(states, dtype=np.uint8)
+    single = states.ndim != 2
+    states = states.reshape(-1, 54)
+    packed = states[:, :27] * 6 + states[:, 27:]
+    if single :
+        return packed[0].tobytes()
+    return [p.tobytes() for p in packed]
+
+# Symmetries.
+# Each facelet has a position (the centre of its cubie, in {-1,0,1}^3, x right, y up, z front)
+# and a normal (the face it is on).  The 48 symmetries of the cube (24 rotations, each with or 
+# without a mirror) are the 3x3 signed permutation matrices acting on these vectors.
+def _facelet_geometry() :
+    pos = np.zeros((54,3), dtype=int)
+    normal = np.zeros((54,3), dtype=int)
+    for f in range(6) :
+        for r in range(3) :
+            for c in range(3) :
+                pos[f*9 + r*3 + c], normal[f*9 + r*3 + c] = {
+                    0 : ((c-1, 1, r-1), (0, 1, 0)),   # U
+                    1 : ((-1, 1-r, c-1), (-1, 0, 0)), # L
+                    2 : ((c-1, 1-r, 1), (0, 0, 1)),   # F
+                    3 : ((1, 1-r, 1-c), (1, 0, 0)),   # R
+                    4 : ((1-c, 1-r, -1), (0, 0, -1)), # B
+                    5 : ((c-1, -1, 1-r), (0, -1, 0)), # D
+                    }[f]
+    return pos, normal
+
+def _build_symmetry_tables() :
+    """
+    SYMMETRY_PERMS[k, i]: where facelet i goes under symmetry k.
+    SYMMETRY_COLOURS[k, c]: the colour (face) that colour c becomes, so the solved cube maps to itself.
+    Symmetry 0 is the identity.
+    """
+    pos, normal = _facelet_geometry()
+    facelet = {(tuple(p), tuple(n)) : i for i, (p, n) in enumerate(zip(pos, normal))}
+    face = {tuple(normal[f*9 + 4]) : f for f in range(6)}
+    perms = []
+    colours = []
+    for axes in itertools.permutations(range(3)) :
+        for signs in itertools.product((1, -1), repeat=3) :
+            M = np.zeros((3,3), dtype=int)
+            M[range(3), axes] = signs
+            perms.append([facelet[(tuple(M @ p), tuple(M @ n))] for p, n in zip(pos, normal)])
+            colours.append([face[tuple(M @ normal[f*9 + 4])] for f in range(6)])
+    return np.array(perms), np.array(colours, dtype=np.uint8)
+
+SYMMETRY_PERMS, SYMMETRY_COLOURS = _build_symmetry_tables()
+# gather form: symmetric state k is SYMMETRY_COLOURS[k][state[SYMMETRY_GATHER[k]]]
+SYMMETRY_GATHER = np.argsort(SYMMETRY_PERMS, axis=1)
+_BASE6 = 6 ** np.arange(17, -1, -1, dtype=np.int64)
+
+def symmetric_states(states) :
+    """
+    All 48 symmetric images of each state in an (N, 54) batch, as an (N, 48, 54) array.
+    The facelets are moved by the symmetry and the colours relabelled to match,
+    so every image is the same distance from solved.
+    """
+    states = np.asarray(states, dtype=np.uint8).reshape(-1, 54)
+    images = states[:, SYMMETRY_GATHER]                              # (N, 48, 54)
+    return SYMMETRY_COLOURS[np.arange(48)[:, None], images]
+
+def canonical_state(states) :
+    """
+    Canonical representative of each state under the 48 symmetries: the image that is
+    lexicographically smallest as a facelet vector.
+    Returns the (N, 54) canonical states and the (N,) symmetry index used, 
+    i.e. canonical = SYMMETRY_COLOURS[k][state[SYMMETRY_GATHER[k]]]
+    """
+    images = symmetric_states(states)
+    # 54 base-6 digits as 3 int64 words, then compare word by word
+    words = images.reshape(len(images), 48, 3, 18).astype(np.int64) @ _BASE6
+    candidates = np.ones(words.shape[:2], dtype=bool)
+    for w in range(3) :
+        word = np.where(candidates, words[:, :, w], np.iinfo(np.int64).max)
+        candidates &= word == word.min(axis=1, keepdims=True)
+    sym = np.argmax(candidates, axis=1)
+    return images[np.arange(len(images)), sym], sym
+
+def canonical_key(states) :
+    """
+    state_key of the canonical state: equal for all states that are symmetric to each other.
+    1 key for a single state, a list of keys for an (N, 54) batch.
+    Not a key for cached rewards: the distance estimate is not symmetry invariant
+    (matrix_dist depends on the colour numbers).
+    """
+    states = np.asarray(states, dtype=np.uint8)
+    canon, sym = canonical_state(states)
+    if states.ndim != 2 :
+        return state_key(canon[0])
+    return state_key(canon)
+
+# ROTATE_TABLE[i] is the facelet permutation for VALID_ROTATES[i]
+ROTATE_TABLE = _build_rotate_table()
+ROTATE_CODES = {r : i for i, r in enumerate(VALID_ROTATES)}
+IDENTITY_PERM = np.arange(54)
+SOLVED_STATE = np.repeat(np.arange(6, dtype=np.uint8), 9)
+
+def rotation_code(r) :
+    # index of rotation r in VALID_ROTATES: every rotation name is checked here
+    code = ROTATE_CODES.get(r)
+    if code is None :
+        raise ValueError(f"Invalid rotation {r}")
+    return code
+
+# Distance estimate.
+# Each entropy measure is rescaled linearly from its range to 1-20 rotations, clipped like np.interp,
+# and then averaged with weights 3:1:1.  The rescaling and the weights are fused into these coefficients.
+DISTANCE_RANGES = np.array([[8,32], [12,54], [6,22]]) # align, naive, matrix
+DISTANCE_SCALE = 19 / (DISTANCE_RANGES[:,1] - DISTANCE_RANGES[:,0])
+DISTANCE_OFFSET = 1 - DISTANCE_RANGES[:,0] * DISTANCE_SCALE
+DISTANCE_WEIGHTS = np.array([3,1,1]) / 5
+_SCALE, _OFFSET, _WEIGHTS = DISTANCE_SCALE.tolist(), DISTANCE_OFFSET.tolist(), DISTANCE_WEIGHTS.tolist()
+
+def estimate_distance(states) :
+    """
+    Batched Cube.estimate_distance: states is (N, 54), or anything that reshapes to it.
+    Returns an (N,) array of estimated rotations to the solved state, 0 for solved states.
+    """
+    states = np.asarray(states).reshape(-1, 54)
+    if Cube.pattern_db is not None :
+        return Cube.pattern_db.heuristic(states).astype(float)
+    naive = (states != SOLVED_STATE).sum(axis=1)
+    matrix = np.sqrt(((states.astype(np.int16) - SOLVED_STATE)**2).sum(axis=1))
+    e = np.stack([align_entropy(states), naive, matrix], axis=1)
+    dist = np.clip(e * DISTANCE_SCALE + DISTANCE_OFFSET, 1, 20) @ DISTANCE_WEIGHTS
+    return np.where(naive == 0, 0, dist)
+
+def get_reward(states) :
+    # Batched Cube.get_reward, (N,) rewards in (0,1], 1 for solved states
+    return 10/(estimate_distance(states)+10)
+
+def _build_successors() :
+    """
+    Rotations allowed after the last rotation: no 2 rotations of the same face in a row,
+    and rotations of opposite faces (which commute, e.g. R1 L1 == L1 R1) only in 1 order.
+    Faces are in the order R, L, U, D, F, B so opposite faces are f and f^1, 
+    and the lower face comes first (R before L, U before D, F before B).
+    """
+    n = len(VALID_ROTATES)
+    codes = []
+    for last in range(n + 1) : # n = no last rotation
+        last_face = last // 3
+        codes.append(np.array([m for m in range(n) if last == n or not 
+                              (m//3 == last_face or (m//3 == last_face ^ 1 and m//3 < last_face))]))
+    successors = {VALID_ROTATES[last] : tuple(VALID_ROTATES[m] for m in codes[last]) for last in range(n)}
+    successors[None] = VALID_ROTATES
+    return successors, codes
+
+# SUCCESSORS[r] is a tuple of the rotations allowed after rotation r (SUCCESSORS[None] after none),
+# SUCCESSOR_CODES[i] the same as codes, after code i (i = 18 for none).  13.5 on average.
+SUCCESSORS, SUCCESSOR_CODES = _build_successors()
+
+def compose_moves(m) :
+    """
+    Compose a sequence of rotations into a single facelet permutation.
+    cube.flat[compose_moves(m)] is the same as applying each rotation in m in turn.
+    """
+    perm = IDENTITY_PERM
+    for r in m :
+        perm = perm[ROTATE_TABLE[rotation_code(r)]]
+    return perm
 
 
 class Cube :
@@ -16,29 +353,44 @@ class Cube :
         Cubicle: one of the locations that can hold a Cubelet.  Upper case notation.
     """
     
+    # map colours to faces on the cube
+    # cube is oriented white up, green front
+    # example:
+    # u_colour = colours[faces.index('U')]
+    # These are constants, shared by all Cube objects at class level.
+    colours = ['white', 'orange', 'green', 'red', 'blue', 'yellow']
+    faces = ['U', 'L', 'F', 'R', 'B', 'D']
+    # The cube is represented as 6 faces with 3x3 stickers or facelets, 1 byte each
+    solved_cube = SOLVED_STATE.reshape(6,3,3)
+    valid_rotates = list(VALID_ROTATES)
+    # Optional pattern_db.PatternDatabase, see pattern_db.use_for_rewards()
+    pattern_db = None
+
+    # Only the state is stored per object, search trees create a lot of cubes
+    __slots__ = ('cube', 'entropy', 'moves')
+
     def __init__(self) :
-        # map colours to faces on the cube
-        # cube is oriented white up, green front
-        # example:
-        # u_colour = colours[faces.index('U')]
-
-        self.colours = ['white', 'orange', 'green', 'red', 'blue', 'yellow']
-        self.faces = ['U', 'L', 'F', 'R', 'B', 'D']
-            
-        # The cube is represented as 6 faces with 3x3 stickers or facelets
-        self.solved_cube=np.zeros((6,3,3), dtype=int)
-        # initialize the colours on each face
-        for f in range(6):
-            self.solved_cube[f] = f
-        
         self.cube = np.copy(self.solved_cube)
-
         self.entropy = 0
-        self.valid_rotates = ['R1', 'R2', 'R3', 'L1', 'L2', 'L3', \
-                            'U1', 'U2', 'U3', 'D1', 'D2', 'D3', \
-                            'F1', 'F2', 'F3', 'B1', 'B2', 'B3']
         self.moves = []
         # to  get reverse moves, use: self.moves[::-1]
+
+    def child(self, r) :
+        """
+        Return a new Cube after rotation r.
+        Only the facelet buffer is new: the move history is not copied, 
+        the search tree keeps it in the parent_action links.
+        """
+        return Cube.from_state(self.cube.reshape(54)[ROTATE_TABLE[rotation_code(r)]])
+
+    @classmethod
+    def from_state(cls, state) :
+        # New cube using the facelet array state (54 or 6x3x3), not copied, with no move history
+        new = cls.__new__(cls)
+        new.cube = state.reshape(6,3,3)
+        new.entropy = 0
+        new.moves = []
+        return new
         
     def reset(self) :
         # initialize the colours on each face
@@ -58,8 +410,8 @@ class Cube :
     def matrix_dist(self) :
         # Euclidian distance to solved state
         # range: 6-22
-        cube0 = self.solved_cube.flatten()
-        cube1 = self.vector_cube()
+        cube0 = self.solved_cube.flatten().astype(int)
+        cube1 = self.vector_cube().astype(int)
         dist = np.linalg.norm(cube1-cube0)
         return dist
 
@@ -72,125 +424,7 @@ class Cube :
     def align_entropy(self) :
         # A measure based on alignment of corners and edges, which is always a step towards solved state.
         # range: 8 - 32
-        max_entropy = 8*4
-        align = 0
-                
-        UFL = (self.cube[0,2,0], self.cube[2,0,0], self.cube[1,0,2]) 
-        URF = (self.cube[0,2,2], self.cube[3,0,0], self.cube[2,0,2]) 
-        ULB = (self.cube[0,0,0], self.cube[1,0,0], self.cube[4,0,2])
-        UBR = (self.cube[0,0,2], self.cube[4,0,0], self.cube[3,0,2])
-        DLF = (self.cube[5,0,0], self.cube[1,2,2], self.cube[2,2,0])
-        DFR = (self.cube[5,0,2], self.cube[2,2,2], self.cube[3,2,0])
-        DLB = (self.cube[5,2,0], self.cube[1,2,0], self.cube[4,2,2])
-        DBR = (self.cube[5,2,2], self.cube[4,2,0], self.cube[3,2,2])
-        
-        UF = (self.cube[0,2,1], self.cube[2,0,1]) 
-        UL = (self.cube[0,1,0], self.cube[1,0,1]) 
-        UB = (self.cube[0,0,1], self.cube[4,0,1]) 
-        UR = (self.cube[0,1,2], self.cube[3,0,1]) 
-
-        LF = (self.cube[1,1,2], self.cube[2,1,0]) 
-        LB = (self.cube[1,1,0], self.cube[4,1,2]) 
-        RF = (self.cube[3,1,0], self.cube[2,1,2]) 
-        BR = (self.cube[4,1,0], self.cube[3,1,2]) 
-
-        DF = (self.cube[5,0,1], self.cube[2,2,1]) 
-        DL = (self.cube[5,1,0], self.cube[1,2,1]) 
-        DB = (self.cube[5,2,1], self.cube[4,2,1]) 
-        DR = (self.cube[5,1,2], self.cube[3,2,1]) 
-
-        U = self.cube[0,1,1]
-        L = self.cube[1,1,1]
-        F = self.cube[2,1,1]
-        R = self.cube[3,1,1]
-        B = self.cube[4,1,1]
-        D = self.cube[5,1,1]
-        
-        # UFL should align with UF, LF, UL
-        # UFL should align with U, F, L
-        if UFL[0] == UF[0] and UFL[1] == UF[1] :
-            align += 1
-        if UFL[2] == LF[0] and UFL[1] == LF[1] :
-            align += 1
-        if UFL[0] == UL[0] and UFL[2] == UL[1] :
-            align += 1
-        if UFL[0] == U and UFL[1] == F :
-            align += 1
-        
-        # URF should align with UR, RF, UF
-        # URF should align with U, R, L
-        if URF[0] == UR[0] and URF[1] == UR[1] :
-            align += 1
-        if URF[1] == RF[0] and URF[2] == RF[1] :
-            align += 1
-        if URF[0] == UF[0] and URF[2] == UF[1] :
-            align += 1
-        if URF[0] == U and URF[1] == R :
-            align += 1
-        
-        # ULB should align with UL, LB, UB
-        # ULB should align with U, L, B
-        if ULB[0] == UL[0] and ULB[1] == UL[1] :
-            align += 1
-        if ULB[1] == LB[0] and ULB[2] == LB[1] :
-            align += 1
-        if ULB[0] == UB[0] and ULB[2] == UB[1] :
-            align += 1
-        if ULB[0] == U and ULB[1] == L :
-            align += 1
-        
-        # UBR should align with UB, BR, UR
-        # UBR should align with U, B, R
-        if UBR[0] == UB[0] and UBR[1] == UB[1] :
-            align += 1
-        if UBR[1] == BR[0] and UBR[2] == BR[1] :
-            align += 1
-        if UBR[0] == UR[0] and UBR[2] == UR[1] :
-            align += 1
-        if UBR[0] == U and UBR[1] == B :
-            align += 1
-        
-        # DLF should align with DL, LF, DF
-        if DLF[0] == DL[0] and DLF[1] == DL[1] :
-            align += 1
-        if DLF[1] == LF[0] and DLF[2] == LF[1] :
-            align += 1
-        if DLF[0] == DF[0] and DLF[2] == DF[1] :
-            align += 1
-        if DLF[0] == D and DLF[1] == L :
-            align += 1
-        
-        # DFR should align with DF, RF, DR
-        if DFR[0] == DF[0] and DFR[1] == DF[1] :
-            align += 1
-        if DFR[1] == RF[1] and DFR[2] == RF[0] :
-            align += 1
-        if DFR[0] == DR[0] and DFR[2] == DR[1] :
-            align += 1
-        if DFR[0] == D and DFR[1] == F :
-            align += 1
-        
-        # DLB should align with DL, LB, DB
-        if DLB[0] == DL[0] and DLB[1] == DL[1] :
-            align += 1
-        if DLB[1] == LB[0] and DLB[2] == LB[1] :
-            align += 1
-        if DLB[0] == DB[0] and DLB[2] == DB[1] :
-            align += 1
-        if DLB[0] == D and DLB[1] == L :
-            align += 1
-        
-        # DBR should align with DB, BR, DR
-        if DBR[0] == DB[0] and DBR[1] == DB[1] :
-            align += 1
-        if DBR[1] == BR[0] and DBR[2] == BR[1] :
-            align += 1
-        if DBR[0] == DR[0] and DBR[2] == DR[1] :
-            align += 1
-        if DBR[0] == D and DBR[1] == B :
-            align += 1
-        
-        return max_entropy - align
+        return align_entropy(self.cube.reshape(54))
     
     def update_entropy(self, style='naive') :
         if style == 'off' :
@@ -201,6 +435,11 @@ class Cube :
             self.entropy = self.naive_entropy()
         elif style == 'matrix' :
             self.entropy = self.matrix_dist()
+        elif style == 'pdb' :
+            if self.pattern_db is None :
+                print("No pattern database loaded")
+            else :
+                self.entropy = int(self.pattern_db.heuristic(self.cube)[0])
         else :
             print("Invalid Entropy Style")
         return self.entropy
@@ -216,18 +455,21 @@ class Cube :
         # estimate the number of moves to solved state
         # range: 1-20
         # simple linear rescaling of entropy measures with weighted average
-        if self.is_solved() :
+        # (scalar version of the module estimate_distance, for 1 cube numpy calls cost more than the arithmetic)
+        # With a pattern database, it is the admissible distance from the database instead.
+        if self.pattern_db is not None :
+            return float(self.pattern_db.heuristic(self.cube)[0])
+        s = self.cube.reshape(54)
+        diff = s != SOLVED_STATE
+        naive = np.count_nonzero(diff)
+        if naive == 0 :
             return 0
-        e1 = self.align_entropy() 
-        e1 = np.interp(e1, [8,32], [1,20])
-        e2 = self.naive_entropy()
-        e2 = np.interp(e2, [12,54], [1,20])
-        e3 = self.matrix_dist()
-        e3 = np.interp(e3, [6,22], [1,20])
-        values = np.array([e1,e2,e3])
-        weights = [3,1,1]
-        w_avg = np.average(values, weights=weights)
-        return w_avg
+        d = s[diff].astype(np.int16) - SOLVED_STATE[diff]
+        values = (align_entropy(s), naive, math.sqrt(np.dot(d, d)))
+        dist = 0.0
+        for v, scale, offset, weight in zip(values, _SCALE, _OFFSET, _WEIGHTS) :
+            dist += weight * min(max(v*scale + offset, 1.0), 20.0)
+        return dist
         
     def get_reward(self) :
         """
@@ -238,119 +480,21 @@ class Cube :
         """
         return (10/(self.estimate_distance()+10))
 
-    def rotate(self, r, level=1) :
-        
-        def rotate_face(f) :
-                save = np.copy(self.cube[f,0,:])
-                self.cube[f,0,:] = np.flip(self.cube[f,:,0])
-                self.cube[f,:,0] = self.cube[f,2,:]
-                self.cube[f,2,:] = np.flip(self.cube[f,:,2])
-                self.cube[f,:,2] = save
-
-        match r :
-            case 'R1' :
-                rotate_face(3)
-                save = np.copy(self.cube[0,:,2])
-                self.cube[0,:,2] = self.cube[2,:,2]
-                self.cube[2,:,2] = self.cube[5,:,2]                
-                self.cube[5,:,2] = np.flip(self.cube[4,:,0])
-                self.cube[4,:,0] = np.flip(save)
-
-            case 'R2' :
-                self.rotate('R1', level+1)
-                self.rotate('R1', level+1)
-            case 'R3' :
-                self.rotate('R1', level+1)
-                self.rotate('R1', level+1)
-                self.rotate('R1', level+1)
-                
-            case 'L1' :
-                rotate_face(1)
-                save = np.copy(self.cube[0,:,0])
-                self.cube[0,:,0] = np.flip(self.cube[4,:,2])
-                self.cube[4,:,2] = np.flip(self.cube[5,:,0])
-                self.cube[5,:,0] = self.cube[2,:,0]
-                self.cube[2,:,0] = save
-            case 'L2' :
-                self.rotate('L1', level+1)
-                self.rotate('L1', level+1)
-            case 'L3' :
-                self.rotate('L1', level+1)
-                self.rotate('L1', level+1)
-                self.rotate('L1', level+1)
-
-            case 'U1' :
-                rotate_face(0)
-                save = np.copy(self.cube[1,0,:])
-                self.cube[1,0,:] = self.cube[2,0,:]
-                self.cube[2,0,:] = self.cube[3,0,:]
-                self.cube[3,0,:] = self.cube[4,0,:]
-                self.cube[4,0,:] = save
-            case 'U2' :
-                self.rotate('U1', level+1)
-                self.rotate('U1', level+1)
-            case 'U3' :
-                self.rotate('U1', level+1)
-                self.rotate('U1', level+1)
-                self.rotate('U1', level+1)
-                
-            case 'D1' :
-                rotate_face(5)
-                save = np.copy(self.cube[2,2,:])
-                self.cube[2,2,:] = self.cube[1,2,:]
-                self.cube[1,2,:] = self.cube[4,2,:]
-                self.cube[4,2,:] = self.cube[3,2,:]
-                self.cube[3,2,:] = save
-            case 'D2' :
-                self.rotate('D1', level+1)
-                self.rotate('D1', level+1)
-            case 'D3' :
-                self.rotate('D1', level+1)
-                self.rotate('D1', level+1)
-                self.rotate('D1', level+1)
-                
-            case 'F1' :
-                rotate_face(2)
-                save = np.copy(self.cube[0,2,:])
-                self.cube[0,2,:] = np.flip(self.cube[1,:,2])
-                self.cube[1,:,2] = self.cube[5,0,:]
-                self.cube[5,0,:] = np.flip(self.cube[3,:,0])
-                self.cube[3,:,0] = save
-            case 'F2' :
-                self.rotate('F1', level+1)
-                self.rotate('F1', level+1)
-            case 'F3' :
-                self.rotate('F1', level+1)
-                self.rotate('F1', level+1)
-                self.rotate('F1', level+1)
-                
-            case 'B1' :
-                rotate_face(4)
-                save = np.copy(self.cube[0,0,:])
-                self.cube[0,0,:] = self.cube[3,:,2]
-                self.cube[3,:,2] = np.flip(self.cube[5,2,:])
-                self.cube[5,2,:] = self.cube[1,:,0]
-                self.cube[1,:,0] = np.flip(save)
-                
-            case 'B2' :
-                self.rotate('B1', level+1)
-                self.rotate('B1', level+1)
-            case 'B3' :
-                self.rotate('B1', level+1)
-                self.rotate('B1', level+1)
-                self.rotate('B1', level+1)
-                
-            case _ :
-                print(f"Invalid rotation {r}")
-                return 1
-            
-        if level ==1 :
-            self.moves.append(r)
+    def rotate(self, r) :
+        """
+        Apply a single rotation as one gather over the 54 facelets.
+        R2 and R3 cost the same as R1.
+        Raises ValueError for an invalid rotation, as move().
+        """
+        self.cube = self.cube.reshape(54)[ROTATE_TABLE[rotation_code(r)]].reshape(6,3,3)
+        self.moves.append(r)
 
     def move(self, m) :
-        # m is an array of valid rotations
-        for r in m :
-            self.rotate(r)
+        # m is an array of valid rotations, composed into 1 permutation before it is applied
+        # (ValueError for an invalid rotation, before the cube is changed)
+        perm = compose_moves(m)
+        self.cube = self.cube.reshape(54)[perm].reshape(6,3,3)
+        self.moves.extend(m)
         self.update_entropy()
 
     def rand_move(self, k) :
@@ -378,17 +522,10 @@ class Cube :
     def get_possible_actions(self, parent_action=None) :
         """
         Return possible next rotations, without repeating a rotation on the same face
-        as the parent.
-        The default action 'XX' will return a list of all valid rotates, as a copy.
+        as the parent, and with opposite faces in 1 order only (see SUCCESSORS).
+        Returns a shared tuple, all valid rotates for no parent action.
         """
-        if not parent_action :
-            parent_action = 'XX'
-        last_face = parent_action[0]
-        possible_actions = []
-        for v in self.valid_rotates :
-            if v[0] != last_face :
-                possible_actions.append(v)
-        return possible_actions
+        return SUCCESSORS.get(parent_action, SUCCESSORS[None])
 
         
     def show_cube(self) :
@@ -422,3 +559,299 @@ class Cube :
         axs[1,3].pcolor(B, cmap=cmap, norm=norm, edgecolor='k', linewidth=2)
         axs[2,1].pcolor(D, cmap=cmap, norm=norm, edgecolor='k', linewidth=2)
         plt.tight_layout(pad=0.5)
+
+
+class CubeBatch :
+    """
+    A batch of N cube states, stored as an (N, 54) uint8 array.
+    Each row is a flattened Cube.cube, so the same facelet permutations apply.
+    Rotations and entropy measures work on all rows at once, instead of 1 Cube at a time.
+    """
+
+    def __init__(self, states) :
+        self.states = np.array(states, dtype=np.uint8).reshape(-1, 54)
+
+    @classmethod
+    def solved(cls, n) :
+        return cls(np.tile(SOLVED_STATE, (n, 1)))
+
+    @classmethod
+    def from_cubes(cls, cubes) :
+        return cls(np.stack([c.cube.reshape(54) for c in cubes]))
+
+    @classmethod
+    def from_moves(cls, state, moves) :
+        """
+        Apply each move (sequence of rotations) in moves to the same start state.
+        Row i is the state after moves[i].  Useful to get all children of a node in 1 gather.
+        """
+        perms = np.stack([compose_moves(m) for m in moves])
+        return cls(np.asarray(state).reshape(54)[perms])
+
+    def __len__(self) :
+        return len(self.states)
+
+    def to_cubes(self) :
+        cubes = []
+        for s in self.states :
+            cube = Cube()
+            cube.cube = s.reshape(6,3,3).copy()
+            cubes.append(cube)
+        return cubes
+
+    def rotate(self, r) :
+        """
+        r is either 1 rotation for every row, e.g. 'R1', 
+        or a list of rotations with 1 per row.
+        """
+        if isinstance(r, str) :
+            self.states = self.states[:, ROTATE_TABLE[rotation_code(r)]]
+        else :
+            codes = [rotation_code(x) for x in r]
+            self.states = np.take_along_axis(self.states, ROTATE_TABLE[codes], axis=1)
+
+    def move(self, m) :
+        # m is an array of valid rotations, applied to every row
+        self.states = self.states[:, compose_moves(m)]
+
+    def is_solved(self) :
+        return (self.states == SOLVED_STATE).all(axis=1)
+
+    def naive_entropy(self) :
+        return (self.states != SOLVED_STATE).sum(axis=1)
+
+    def matrix_dist(self) :
+        return np.linalg.norm(self.states.astype(int) - SOLVED_STATE, axis=1)
+
+    def align_entropy(self) :
+        return align_entropy(self.states)
+
+    def estimate_distance(self) :
+        return estimate_distance(self.states)
+
+    def get_reward(self) :
+        return get_reward(self.states)
+
+
+# Cubie model.
+# Corners and edges are numbered as cubicles (locations), in the usual Kociemba order.
+# The facelets of each cubicle are listed clockwise, starting from the U/D facelet 
+# (or the F/B facelet for the middle layer edges), which defines orientation 0.
+# Facelets are flat indices into Cube.cube, i.e. face*9 + row*3 + col
+CORNER_NAMES = ('URF', 'UFL', 'ULB', 'UBR', 'DFR', 'DLF', 'DBL', 'DRB')
+CORNER_FACELETS = np.array([[ 8, 27, 20], # URF : U[2,2], R[0,0], F[0,2]
+                            [ 6, 18, 11], # UFL : U[2,0], F[0,0], L[0,2]
+                            [ 0,  9, 38], # ULB : U[0,0], L[0,0], B[0,2]
+                            [ 2, 36, 29], # UBR : U[0,2], B[0,0], R[0,2]
+                            [47, 26, 33], # DFR : D[0,2], F[2,2], R[2,0]
+                            [45, 17, 24], # DLF : D[0,0], L[2,2], F[2,0]
+                            [51, 44, 15], # DBL : D[2,0], B[2,2], L[2,0]
+                            [53, 35, 42]]) # DRB : D[2,2], R[2,2], B[2,0]
+EDGE_NAMES = ('UR', 'UF', 'UL', 'UB', 'DR', 'DF', 'DL', 'DB', 'FR', 'FL', 'BL', 'BR')
+EDGE_FACELETS = np.array([[ 5, 28], # UR : U[1,2], R[0,1]
+                          [ 7, 19], # UF : U[2,1], F[0,1]
+                          [ 3, 10], # UL : U[1,0], L[0,1]
+                          [ 1, 37], # UB : U[0,1], B[0,1]
+                          [50, 34], # DR : D[1,2], R[2,1]
+                          [46, 25], # DF : D[0,1], F[2,1]
+                          [48, 16], # DL : D[1,0], L[2,1]
+                          [52, 43], # DB : D[2,1], B[2,1]
+                          [23, 30], # FR : F[1,2], R[1,0]
+                          [21, 14], # FL : F[1,0], L[1,2]
+                          [41, 12], # BL : B[1,2], L[1,0]
+                          [39, 32]]) # BR : B[1,0], R[1,2]
+CORNER_COLOURS = SOLVED_STATE[CORNER_FACELETS]
+EDGE_COLOURS = SOLVED_STATE[EDGE_FACELETS]
+
+def _build_cubie_lookups() :
+    # colour triple (in cyclic order from the U/D colour) -> corner, colour pair -> edge and flip
+    corner_lookup = np.full(6*6*6, -1, dtype=np.intp)
+    for j, (c0, c1, c2) in enumerate(CORNER_COLOURS) :
+        corner_lookup[c0*36 + c1*6 + c2] = j
+    edge_lookup = np.full(6*6, -1, dtype=np.intp)
+    edge_flip = np.zeros(6*6, dtype=np.uint8)
+    for j, (c0, c1) in enumerate(EDGE_COLOURS) :
+        edge_lookup[c0*6 + c1] = j
+        edge_lookup[c1*6 + c0] = j
+        edge_flip[c1*6 + c0] = 1
+    return corner_lookup, edge_lookup, edge_flip
+
+CORNER_LOOKUP, EDGE_LOOKUP, EDGE_FLIP = _build_cubie_lookups()
+
+def facelets_to_cubies(states) :
+    """
+    Convert an (N, 54) array of facelet states to cubie arrays.
+    Returns cp, co (N, 8) and ep, eo (N, 12).
+    cp[n,i] is the corner cubie in cubicle i, co[n,i] its twist (0-2).  Same for edges and flips (0-1).
+    """
+    states = np.asarray(states).reshape(-1, 54)
+    cc = states[:, CORNER_FACELETS].astype(np.intp)   # (N, 8, 3)
+    co = np.argmax((cc == 0) | (cc == 5), axis=2)      # which facelet shows the U/D colour
+    k = (co[:, :, None] + np.arange(3)) % 3
+    cc = np.take_along_axis(cc, k, axis=2)
+    cp = CORNER_LOOKUP[cc[:,:,0]*36 + cc[:,:,1]*6 + cc[:,:,2]]
+    ec = states[:, EDGE_FACELETS].astype(np.intp)      # (N, 12, 2)
+    e = ec[:,:,0]*6 + ec[:,:,1]
+    ep = EDGE_LOOKUP[e]
+    eo = EDGE_FLIP[e]
+    if (cp < 0).any() or (ep < 0).any() :
+        raise Exception("Invalid cube state, cannot convert to cubies")
+    return cp.astype(np.uint8), co.astype(np.uint8), ep.astype(np.uint8), eo
+
+def cubies_to_facelets(cp, co, ep, eo) :
+    # inverse of facelets_to_cubies, returns an (N, 54) uint8 array
+    cp = np.asarray(cp, dtype=np.intp).reshape(-1, 8)
+    co = np.asarray(co, dtype=np.intp).reshape(-1, 8)
+    ep = np.asarray(ep, dtype=np.intp).reshape(-1, 12)
+    eo = np.asarray(eo, dtype=np.intp).reshape(-1, 12)
+    states = np.tile(SOLVED_STATE, (len(cp), 1))
+    rows = np.arange(len(cp))[:, None, None]
+    k = (np.arange(3) + co[:, :, None]) % 3
+    states[rows, CORNER_FACELETS[np.arange(8)[:, None], k]] = CORNER_COLOURS[cp]
+    k = (np.arange(2) + eo[:, :, None]) % 2
+    states[rows, EDGE_FACELETS[np.arange(12)[:, None], k]] = EDGE_COLOURS[ep]
+    return states
+
+def _build_cubie_move_tables() :
+    # For each rotation: new_cp[i] = cp[CP_MOVE[m,i]], new_co[i] = (co[CP_MOVE[m,i]] + CO_MOVE[m,i]) % 3
+    # Derived from the facelet tables: the first facelet of cubicle i comes from sticker k of cubicle j.
+    corner_of = {f : (j, k) for j, fs in enumerate(CORNER_FACELETS) for k, f in enumerate(fs)}
+    edge_of = {f : (j, k) for j, fs in enumerate(EDGE_FACELETS) for k, f in enumerate(fs)}
+    cp_move = np.zeros((len(VALID_ROTATES), 8), dtype=np.intp)
+    co_move = np.zeros((len(VALID_ROTATES), 8), dtype=np.uint8)
+    ep_move = np.zeros((len(VALID_ROTATES), 12), dtype=np.intp)
+    eo_move = np.zeros((len(VALID_ROTATES), 12), dtype=np.uint8)
+    for m, perm in enumerate(ROTATE_TABLE) :
+        for i in range(8) :
+            j, k = corner_of[perm[CORNER_FACELETS[i,0]]]
+            cp_move[m,i], co_move[m,i] = j, (-k) % 3
+        for i in range(12) :
+            j, k = edge_of[perm[EDGE_FACELETS[i,0]]]
+            ep_move[m,i], eo_move[m,i] = j, k
+    return cp_move, co_move, ep_move, eo_move
+
+CP_MOVE, CO_MOVE, EP_MOVE, EO_MOVE = _build_cubie_move_tables()
+
+def _perm_rank(p) :
+    # Lehmer code of a permutation, 0 .. n!-1
+    n = len(p)
+    rank = 0
+    for i in range(n) :
+        rank = rank * (n - i) + sum(1 for x in p[i+1:] if x < p[i])
+    return int(rank)
+
+def _perm_unrank(rank, n) :
+    digits = []
+    for i in range(1, n+1) :
+        digits.append(rank % i)
+        rank //= i
+    items = list(range(n))
+    return [items.pop(d) for d in digits[::-1]]
+
+N_CORNER_ORI = 3**7
+N_EDGE_ORI = 2**11
+N_CORNER_PERM = 40320      # 8!
+N_EDGE_PERM = 479001600    # 12!
+
+
+class CubieCube :
+    """
+    Cubie level representation: which cubie is in each cubicle, and how it is twisted / flipped.
+    All 4 arrays share 1 buffer of 40 bytes (vs 54 bytes of uint8 facelets in Cube.cube).
+    Centres never move, so they are not stored.
+    Conversion to and from the facelet array is lossless for any reachable state.
+    """
+    __slots__ = ('cubies',)
+
+    def __init__(self, cubies=None) :
+        if cubies is None :
+            cubies = np.concatenate([np.arange(8), np.zeros(8), np.arange(12), np.zeros(12)])
+        self.cubies = np.array(cubies, dtype=np.uint8)
+
+    @property
+    def cp(self) :
+        return self.cubies[0:8]
+
+    @property
+    def co(self) :
+        return self.cubies[8:16]
+
+    @property
+    def ep(self) :
+        return self.cubies[16:28]
+
+    @property
+    def eo(self) :
+        return self.cubies[28:40]
+
+    @classmethod
+    def from_facelets(cls, facelets) :
+        cp, co, ep, eo = facelets_to_cubies(facelets)
+        return cls(np.concatenate([cp[0], co[0], ep[0], eo[0]]))
+
+    @classmethod
+    def from_cube(cls, cube) :
+        return cls.from_facelets(cube.cube)
+
+    def to_facelets(self) :
+        return cubies_to_facelets(self.cp, self.co, self.ep, self.eo)[0].reshape(6,3,3)
+
+    def to_cube(self) :
+        cube = Cube()
+        cube.cube = self.to_facelets()
+        return cube
+
+    def __eq__(self, other) :
+        return isinstance(other, CubieCube) and (self.cubies == other.cubies).all()
+
+    def __hash__(self) :
+        return hash(self.cubies.tobytes())
+
+    def is_solved(self) :
+        return (self.cubies == CubieCube().cubies).all()
+
+    def rotate(self, r) :
+        m = rotation_code(r)
+        cp, co, ep, eo = self.cp, self.co, self.ep, self.eo
+        self.cubies = np.concatenate([cp[CP_MOVE[m]], (co[CP_MOVE[m]] + CO_MOVE[m]) % 3, 
+                                      ep[EP_MOVE[m]], (eo[EP_MOVE[m]] + EO_MOVE[m]) % 2])
+
+    def move(self, m) :
+        for r in m :
+            self.rotate(r)
+
+    # Coordinates
+    def corner_orientation(self) :
+        # 0 .. 3^7-1, the twist of the last corner follows from the others
+        return int(np.dot(self.co[:7].astype(int), 3**np.arange(6,-1,-1)))
+
+    def edge_orientation(self) :
+        # 0 .. 2^11-1, the flip of the last edge follows from the others
+        return int(np.dot(self.eo[:11].astype(int), 2**np.arange(10,-1,-1)))
+
+    def corner_permutation(self) :
+        return _perm_rank(self.cp.tolist())
+
+    def edge_permutation(self) :
+        return _perm_rank(self.ep.tolist())
+
+    def to_key(self) :
+        """
+        Single integer that identifies the state, e.g. for hashing, tables or storage.
+        """
+        key = self.corner_permutation()
+        key = key * N_CORNER_ORI + self.corner_orientation()
+        key = key * N_EDGE_PERM + self.edge_permutation()
+        key = key * N_EDGE_ORI + self.edge_orientation()
+        return key
+
+    @classmethod
+    def from_key(cls, key) :
+        key, eo_coord = divmod(key, N_EDGE_ORI)
+        key, ep_coord = divmod(key, N_EDGE_PERM)
+        cp_coord, co_coord = divmod(key, N_CORNER_ORI)
+        co = [(co_coord // 3**i) % 3 for i in range(6,-1,-1)]
+        co.append(-sum(co) % 3)
+        eo = [(eo_coord >> i) & 1 for i in range(10,-1,-1)]
+        eo.append(sum(eo) % 2)
+        return cls(np.concatenate([_perm_unrank(cp_coord, 8), co, _perm_unrank(ep_coord, 12), eo]))
@@ -10,21 +10,26 @@ Make a lot of sample cubes and evaluate solving performance.
 #%% Setup
 from cube import Cube
 import mcts
-from ast import literal_eval
-from csv import writer
+import ida_star
+from csv import DictReader, DictWriter
 from tqdm import tqdm
+import argparse
+import multiprocessing as mp
+import numpy as np
+import os
+import multiprocessing.connection
 import matplotlib.pyplot as plt
 import pandas as pd
 import time
 
 #%% Functions
 
-def plot_it() :
+def plot_it(path='evaluate.csv') :
     
     fig, ax = plt.subplots()
     
-    eval = pd.read_csv('evaluate.csv')
-    bars = eval.groupby(by='Scrambles').mean()
+    eval = pd.read_csv(path)
+    bars = eval.groupby(by='Scrambles')[['Success']].mean()
     
     ax = bars.plot.bar(y='Success')
 
@@ -32,43 +37,205 @@ def plot_it() :
     
     return True
 
-#%% Main
+def compare_engines(scrambles=range(4,12+1), samples=5, iterations=100000, explore_param=0.01, 
+                    max_nodes=1000000, pattern_db=None) :
+    """
+    Solve the same sample cubes with mcts_search and ida_search.
+    Returns rows of [Engine, Scrambles, Success, SolveLength, Elapsed], and prints the success rate per level.
+    """
+    results = []
+    with mcts.SolverPool() as pool :
+        for s in scrambles :
+            success = {'mcts' : 0, 'ida' : 0}
+            for n in tqdm(range(samples)) :
+                rubiks = Cube()
+                rubiks.move(rubiks.rand_move(s))
 
-def main() :
-    iterations = 100000 # iterations per solve attempt
-    explore_param = 0.01
+                root = mcts.TreeHorn(rubiks)
+                tic = time.time()
+                result = mcts.mcts_search(root, iterations=iterations, explore_param=explore_param, pool=pool)
+                elapsed = (time.time()-tic) // 0.01 / 100
+                success['mcts'] += result.solved
+                results.append(['mcts', s, result.solved, len(result.moves), elapsed])
 
-    scrambles = range(12,12+1)
-    samples = 5 # how many samples at each scramble level
-    
-    results = []
-    for s in scrambles :
-        print(f'Level: {s}')
-        success = 0
-        for n in tqdm(range(samples)) :
-            rubiks = Cube()
-            rubiks.move(rubiks.rand_move(s))
-            root = mcts.TreeHorn(rubiks)
-            tic = time.time()
-            solved = mcts.mcts_search(root, iterations=iterations, explore_param=explore_param)
-            toc = time.time()
-            elapsed = (toc-tic) // 0.01 / 100
-            if solved : success += 1
-            result = literal_eval(repr(root))
-            result.append(s)
-            result.append(explore_param)
-            result.append(elapsed)
-            results.append(result)
-        print(f'\nLevel: {s}, success rate: {success/samples:.1%}')
-    
-    headings = ['Success', 'Nodes', 'Depth', 'MaxReward', 'Scrambles', 'Theta', 'Elapsed']
-    with open('evaluate.csv', 'a') as f:
-        write = writer(f)
-#        write.writerow(headings)
-        write.writerows(results)
-    
+                tic = time.time()
+                solved, solve_moves = ida_star.ida_search(rubiks, max_nodes=max_nodes, pattern_db=pattern_db)
+                elapsed = (time.time()-tic) // 0.01 / 100
+                success['ida'] += solved
+                results.append(['ida', s, solved, len(solve_moves), elapsed])
+            print(f"\nLevel: {s}, success rate mcts: {success['mcts']/samples:.1%}, ida: {success['ida']/samples:.1%}")
     return results
 
+#%% Harness
+
+FIELDS = ['Scrambles', 'Sample', 'Seed', 'Iterations', 'Theta', 'RolloutDepth', 'BatchSize', 'TimeLimit',
+          'Success', 'SolveLength', 'Nodes', 'SearchIterations', 'MaxReward', 'Distance', 'Elapsed', 'Moves']
+# a sample is done when a row has the same values in these fields
+KEY_FIELDS = ['Scrambles', 'Seed', 'Iterations', 'Theta', 'RolloutDepth', 'BatchSize', 'TimeLimit']
+
+def sample_seed(base_seed, scrambles, sample) :
+    # deterministic seed for 1 sample, independent of the other samples in the run
+    return int(np.random.SeedSequence([base_seed, scrambles, sample]).generate_state(1)[0])
+
+def scramble(seed, scrambles) :
+    np.random.seed(seed)
+    return Cube().rand_move(scrambles)
+
+def row_key(row) :
+    # as the key fields read back from the CSV file
+    return tuple('' if row[k] is None else str(row[k]) for k in KEY_FIELDS)
+
+def done_keys(path) :
+    """
+    Keys of the samples already in the results file, for resume.
+    """
+    if not os.path.exists(path) :
+        return set()
+    with open(path, newline='') as f :
+        return {row_key(row) for row in DictReader(f)}
+
+class EvalProcess(mp.Process) :
+    """
+    Solves samples (key fields dict, scramble moves) with mcts.solve_many on its own SolverPool,
+    and sends a row dict for each on its own pipe (so a process that is killed cannot block the others).
+    When it stops, it always sends (its name, None), or (its name, error message) if it failed.
+    Not a daemon, because it starts its own rollout workers.
+    """
+
+    def __init__(self, samples, conn, n_workers, search_args) :
+        super().__init__()
+        self.samples = samples
+        self.conn = conn
+        self.n_workers = n_workers
+        self.search_args = search_args
+
+    def run(self) :
+        error = None
+        try :
+            self.solve()
+        except BaseException as e :
+            error = f'{type(e).__name__}: {e}'
+            raise
+        finally :
+            self.conn.send((self.name, error))
+
+    def solve(self) :
+        cubes = []
+        for _, moves in self.samples :
+            rubiks = Cube()
+            rubiks.move(moves)
+            cubes.append(rubiks)
+        with mcts.SolverPool(n_workers=self.n_workers) as pool :
+            for i, result in mcts.solve_many(cubes, pool=pool, **self.search_args) :
+                row, moves = self.samples[i]
+                row = dict(row, Success=result.solved, SolveLength=len(result.moves), Nodes=result.nodes,
+                           SearchIterations=result.iterations, MaxReward=round(10/(result.distance+10), 4),
+                           Distance=round(result.distance, 3), Elapsed=round(result.elapsed, 2),
+                           Moves=' '.join(result.moves))
+                self.conn.send(row)
+
+def run(scrambles=range(4,12+1), samples=5, seed=0, iterations=100000, explore_param=0.01, rollout_depth=1,
+        batch_size=1, time_limit=None, processes=1, n_workers=8, output='evaluate_runs.csv', resume=True,
+        parquet=None) :
+    """
+    Solve samples at each scramble level and append 1 row per sample to the output CSV as soon as
+    it is solved (or given up).  Samples are split over processes, each with n_workers rollout workers.
+    The scramble of a sample depends only on (seed, scrambles, sample number), so runs can be repeated.
+    resume: skip the samples that already have a row with the same key fields.
+    parquet: also write the whole results file as Parquet at the end (needs pyarrow or fastparquet).
+    Returns the number of samples solved in this run.
+    Raises an Exception if a process failed, after writing the rows of the others (run again to resume).
+    """
+    params = {'Iterations' : iterations, 'Theta' : explore_param, 'RolloutDepth' : rollout_depth,
+              'BatchSize' : batch_size, 'TimeLimit' : time_limit}
+    done = done_keys(output) if resume else set()
+    todo = []
+    for s in scrambles :
+        for n in range(samples) :
+            n_seed = sample_seed(seed, s, n)
+            row = dict(Scrambles=s, Sample=n, Seed=n_seed, **params)
+            if row_key(row) in done :
+                continue
+            todo.append((row, scramble(n_seed, s)))
+    print(f'{len(todo)} samples to run, {len(scrambles)*samples - len(todo)} already done')
+
+    new_file = not os.path.exists(output)
+    search_args = dict(iterations=iterations, explore_param=explore_param, rollout_depth=rollout_depth,
+                       batch_size=batch_size, time_limit=time_limit)
+    procs = {}
+    for n in range(min(processes, len(todo))) :
+        reader, sender = mp.Pipe(duplex=False)
+        p = EvalProcess(todo[n::processes], sender, n_workers, search_args)
+        p.start()
+        sender.close()
+        procs[reader] = p
+    solved = 0
+    errors = []
+    with open(output, 'a', newline='') as f, tqdm(total=len(todo)) as progress :
+        write = DictWriter(f, fieldnames=FIELDS)
+        if new_file :
+            write.writeheader()
+        running = dict(procs)
+        while running :
+            ready = mp.connection.wait(list(running), timeout=1)
+            for reader in ready :
+                p = running[reader]
+                try :
+                    row = reader.recv()
+                except (EOFError, OSError) :
+                    p.join(1)
+                    row = (p.name, None if p.exitcode == 0 else f'exited with code {p.exitcode}')
+                if isinstance(row, tuple) :
+                    if row[1] is not None :
+                        errors.append(f'{row[0]}: {row[1]}')
+                    del running[reader]
+                    continue
+                write.writerow(row)
+                f.flush()
+                solved += row['Success']
+                progress.update()
+            # a process killed (e.g. out of memory) sends nothing more, and its rollout workers
+            # may keep the pipe open
+            for reader, p in list(running.items()) :
+                if p.exitcode is not None and p.exitcode != 0 and not reader.poll() :
+                    errors.append(f'{p.name}: exited with code {p.exitcode}')
+                    del running[reader]
+    for p in procs.values() :
+        p.join()
+    if errors :
+        raise Exception(f"{len(errors)} evaluation processes failed, run again to resume: {'; '.join(errors)}")
+
+    if parquet is not None :
+        pd.read_csv(output).to_parquet(parquet)
+    if todo :
+        print(f'Solved {solved} of {len(todo)} ({solved/len(todo):.1%})')
+    return solved
+
+#%% Main
+
+def main() :
+    parser = argparse.ArgumentParser(description='Solve sample cubes and append the results to a CSV file')
+    parser.add_argument('--scrambles', type=int, nargs=2, default=[4, 12], metavar=('MIN', 'MAX'),
+                        help='range of scramble levels, inclusive')
+    parser.add_argument('--samples', type=int, default=5, help='samples at each scramble level')
+    parser.add_argument('--seed', type=int, default=0, help='base seed for the scrambles')
+    parser.add_argument('--iterations', type=int, default=100000, help='iterations per solve attempt')
+    parser.add_argument('--explore-param', type=float, default=0.01)
+    parser.add_argument('--rollout-depth', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--time-limit', type=float, default=None, help='seconds per sample')
+    parser.add_argument('--processes', type=int, default=1, help='processes solving samples')
+    parser.add_argument('--workers', type=int, default=8, help='rollout workers per process')
+    parser.add_argument('--output', default='evaluate_runs.csv')
+    parser.add_argument('--no-resume', action='store_true', help='run samples even if they are in the output')
+    parser.add_argument('--parquet', default=None, help='also save the results as this Parquet file')
+    parser.add_argument('--plot', action='store_true', help='plot the success rate from the output and exit')
+    args = parser.parse_args()
+    if args.plot :
+        return plot_it(args.output)
+    return run(range(args.scrambles[0], args.scrambles[1]+1), args.samples, args.seed, args.iterations,
+               args.explore_param, args.rollout_depth, args.batch_size, args.time_limit, args.processes,
+               args.workers, args.output, not args.no_resume, args.parquet)
+
 if __name__ == '__main__'  :
     results = main()
-    
\ No newline at end of file
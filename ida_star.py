@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Iterative-deepening A* (IDA*) solver, an alternative engine to mcts.mcts_search.
+
+Depth-first search with a bound on f = g + h (rotations so far + estimated rotations to go).
+When the search fails the bound is raised to the smallest f that exceeded it, and the search restarts.
+With an admissible heuristic (a pattern database) the first solution found is optimal.
+With the entropy blend (Cube.estimate_distance) solutions are found faster but may be longer.
+
+Pruning: no 2 rotations of the same face in a row, and rotations of opposite faces
+(which commute, e.g. R1 L1 == L1 R1) only in 1 order.
+The cube state is 1 buffer, moved in place and un-done on the way back up.
+"""
+
+#%% Packages
+import numpy as np
+import time
+from cube import Cube, VALID_ROTATES, ROTATE_TABLE, SOLVED_STATE, SUCCESSOR_CODES, estimate_distance
+
+#%% Functions
+
+# ALLOWED[last] are the rotation codes allowed after rotation code last (18 = no last rotation)
+ALLOWED = SUCCESSOR_CODES
+# undo a rotation with the inverse permutation
+INVERSE_TABLE = np.argsort(ROTATE_TABLE, axis=1)
+
+def blend_heuristic(states) :
+    # the MCTS distance estimate, rounded up.  Not admissible, so solutions may not be optimal.
+    return np.ceil(estimate_distance(states)).astype(int)
+
+class _Search :
+    """
+    State of 1 IDA* search: the state buffer, the path, and counters.
+    """
+    def __init__(self, state, heuristic, max_nodes, deadline, stop=None) :
+        self.state = state
+        self.heuristic = heuristic
+        self.max_nodes = max_nodes
+        self.deadline = deadline
+        self.stop = stop
+        self.path = []
+        self.nodes = 0
+        self.stopped = False
+
+    def search(self, g, bound, last) :
+        """
+        Returns True if solved (self.path holds the solution),
+        or the smallest f over the bound that was seen.
+        """
+        self.nodes += 1
+        if self.nodes % 1024 == 0 :
+            if self.deadline is not None and time.time() > self.deadline :
+                self.stopped = True
+            if self.stop is not None and self.stop() :
+                self.stopped = True
+        if self.max_nodes is not None and self.nodes > self.max_nodes :
+            self.stopped = True
+        if self.stopped :
+            return np.inf
+
+        codes = ALLOWED[last]
+        children = self.state[ROTATE_TABLE[codes]]
+        solved = (children == SOLVED_STATE).all(axis=1)
+        if solved.any() :
+            self.path.append(int(codes[np.argmax(solved)]))
+            return True
+        if g + 1 >= bound :
+            # every child is over the bound: not solved, so h >= 1 and f >= g+2
+            return g + 2
+        hs = self.heuristic(children)
+        f_min = np.inf
+        for i in np.argsort(hs, kind='stable') :
+            f = g + 1 + hs[i]
+            if f > bound :
+                f_min = min(f_min, f)
+                break # sorted by h, so the rest are over the bound too
+            m = codes[i]
+            self.state[:] = self.state[ROTATE_TABLE[m]]
+            self.path.append(int(m))
+            t = self.search(g + 1, bound, m)
+            if t is True :
+                return True
+            self.path.pop()
+            self.state[:] = self.state[INVERSE_TABLE[m]]
+            f_min = min(f_min, t)
+            if self.stopped :
+                break
+        return f_min
+
+def ida_search(cube : Cube, max_depth=20, max_nodes=1000000, deadline=None, pattern_db=None, stop=None) :
+    """
+    Solve the cube with IDA*.
+    cube: Cube to solve, not changed.
+    max_depth: give up when the bound gets over this many rotations.
+    max_nodes: give up after this many nodes (None for no limit).
+    deadline: give up after this time.time() (None for no limit).
+    stop: function checked with the deadline (every 1024 nodes), give up when it returns True.
+    pattern_db: pattern_db.PatternDatabase for an admissible heuristic (optimal solutions),
+        otherwise the MCTS distance estimate is used.
+    Returns (solved, moves): moves is the list of rotations that solves the cube, [] if not solved.
+    """
+    state = cube.cube.reshape(54).astype(np.uint8)
+    if (state == SOLVED_STATE).all() :
+        return True, []
+    heuristic = pattern_db.heuristic if pattern_db is not None else blend_heuristic
+    search = _Search(state, heuristic, max_nodes, deadline, stop)
+    bound = max(int(heuristic(state)[0]), 1)
+    while bound <= max_depth :
+        t = search.search(0, bound, len(VALID_ROTATES))
+        if t is True :
+            return True, [VALID_ROTATES[m] for m in search.path]
+        if search.stopped or t == np.inf :
+            break
+        bound = int(t)
+    return False, []
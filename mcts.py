@@ -13,14 +13,49 @@ Implement the MCTS algorithm for cube solving.
 
 #%% Packages
 import numpy as np
-from cube import Cube
-from copy import deepcopy
+import time
+from collections import deque
+import queue
+from cube import Cube, SUCCESSORS, ROTATE_CODES, ROTATE_TABLE, SOLVED_STATE, get_reward, state_key, compose_moves
 import multiprocessing as mp
+from multiprocessing import shared_memory
 
 #%% Functions
 
 #%% Main
 
+class TreeStats :
+    """
+    Statistics for a whole tree, kept up to date as nodes are added, so the root can 
+    report them without walking the tree.  Shared by all the nodes of the tree.
+    nodes: number of nodes, not counting the root
+    created: number of nodes created, including any removed since (detach, prune_tree)
+    max_depth: depth of the deepest node created, counting the root as 1
+    solved: True once a solved node has been created
+    best_reward, best_moves: the highest reward of any node created, and the rotations 
+        from the root to that node (to the solved node once solved)
+    """
+    __slots__ = ('nodes', 'created', 'max_depth', 'solved', 'best_reward', 'best_moves')
+
+    def __init__(self, reward) :
+        self.nodes = 0
+        self.created = 0
+        self.max_depth = 1
+        self.solved = False
+        self.best_reward = reward
+        self.best_moves = []
+
+    def add(self, node) :
+        self.nodes += 1
+        self.created += 1
+        if node.depth >= self.max_depth :
+            self.max_depth = node.depth + 1
+        if node.reward > self.best_reward :
+            self.best_reward = node.reward
+            self.best_moves = node.get_moves()[len(node.root().state.moves):]
+            if node.reward == 1 :
+                self.solved = True
+
 class TreeHorn :
     """
     Normally the main class is called TreeNode, but I couldn't resist...
@@ -37,23 +72,51 @@ class TreeHorn :
     Reward function for Cube: estimated distance from solved state.
     For the Cube, there is only 1 solved state so we don't cumulate rewards from different policies (as in some MCTS examples)
     
+    Nodes only hold their own facelet state.  The moves to reach a node are rebuilt
+    from the parent_action links, see get_moves().
+
+    With a TranspositionTable, a position reached again by another path is linked to the
+    existing node, so the tree becomes a DAG.  parent is the first parent (the one that 
+    created the node), other parents are in more_parents.  children[i] is always reached
+    with possible_actions[i].
     """
+
+    __slots__ = ('state', 'parent', 'parent_action', 'reward', 'best_reward', 
+                 'children', 'num_visits', 'possible_actions', 'depth', 'more_parents', 'pending', 'stats')
     
-    def __init__(self, state : Cube, parent=None, parent_action=None) :
+    def __init__(self, state : Cube, parent=None, parent_action=None, reward=None) :
         self.state = state 
         self.parent = parent
         self.parent_action = parent_action
 
-        self.reward = self.state.get_reward()
+        # reward can be passed in when it was scored with the siblings, in 1 batch
+        if reward is None :
+            reward = self.state.get_reward()
+        self.reward = reward
         self.best_reward = self.reward
         self.children = [] 
         self.num_visits = 1 # initialize to 1 to stop div0 errors
         self.possible_actions = self.state.get_possible_actions(parent_action)
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.more_parents = None
+        self.pending = 0 # selections waiting for a rollout (virtual loss), see mcts_search
+        if parent is None :
+            self.stats = TreeStats(self.reward)
+            self.stats.solved = bool(self.reward == 1)
+        else :
+            self.stats = parent.stats
+            self.stats.add(self)
 
         return
 
+    def tree_stats(self) :
+        # (max depth, number of children) below this node, without a walk for the root
+        if self.is_root_node() :
+            return self.stats.max_depth, self.stats.nodes
+        return self.traverse()
+
     def __str__(self) :
-        d,c = self.traverse()
+        d,c = self.tree_stats()
         r = self.best_reward
         s = f'Total children:\t {c:,}\n' + \
             f'Max depth:\t\t {d}\n' + \
@@ -61,23 +124,73 @@ class TreeHorn :
         return s
     
     def __repr__(self) :
-        d,c = self.traverse()
+        d,c = self.tree_stats()
         r = self.best_reward
-        s = r == 1
+        # with rollout_depth > 1 the best_reward can be 1 before the solved node is in the tree
+        s = self.stats.solved if self.is_root_node() else r == 1
         return f'[{s},{c},{d},{r:.3f}]'
     
     def traverse(self) :
         """
         go down the tree and collect statistics
+        Nodes shared by several parents (transpositions) are counted once.
+        For the root, self.stats has the same numbers without the walk.
         """
-        childs = len(self.children)
+        childs = 0
         max_depth = 1
-        for child_node in self.children :
-            d, c = child_node.traverse()
-            childs += c
-            max_depth = max(d+1, max_depth)
+        seen = {id(self)}
+        stack = [(self, 1)]
+        while stack :
+            node, d = stack.pop()
+            max_depth = max(d, max_depth)
+            for child_node in node.children :
+                if id(child_node) not in seen :
+                    seen.add(id(child_node))
+                    childs += 1
+                    stack.append((child_node, d+1))
         return max_depth, childs
         
+    def get_moves(self) :
+        """
+        All moves from the root state to this node, including the moves that made the root state.
+        """
+        path = []
+        node = self
+        while node.parent is not None :
+            path.append(node.parent_action)
+            node = node.parent
+        return node.state.moves + path[::-1]
+
+    def root(self) :
+        node = self
+        while node.parent is not None :
+            node = node.parent
+        return node
+
+    def parents(self) :
+        if self.parent is not None :
+            yield self.parent
+        if self.more_parents :
+            yield from self.more_parents
+
+    def has_ancestor(self, node) :
+        # True if node is this node or one of its ancestors, through any parent
+        stack = [self]
+        seen = set()
+        while stack :
+            n = stack.pop()
+            if n is node :
+                return True
+            for p in n.parents() :
+                if id(p) not in seen :
+                    seen.add(id(p))
+                    stack.append(p)
+        return False
+
+    def action_to(self, child) :
+        # the rotation from this node to one of its children
+        return self.possible_actions[self.children.index(child)]
+
     def is_root_node(self):
         if self.parent is None :
             return True
@@ -90,21 +203,104 @@ class TreeHorn :
     def is_fully_expanded(self):
         return ( len(self.children) == len(self.possible_actions) )
 
-    def expand(self):
+    def expand(self, table=None):
         """
         Create child nodes with new state from all possible actions.
+        With a transposition table, a child position that is already in the tree is linked
+        instead of created.  If it is an ancestor of this node (i.e. the move goes back to 
+        a position on the way here) it is dropped, so the DAG never has cycles.
+        Returns False if no children were added, i.e. this node is a dead end.
         """
         if self.is_fully_expanded() :
             raise Exception("Attempt to expand fully-expanded node")
         if self.is_terminal_node() :
             raise Exception("Attempt to expand a solved cube")
 
-        for a in self.possible_actions :
-            next_state = deepcopy(self.state)
-            next_state.move([a]) 
-            child_node = TreeHorn(next_state, parent=self, parent_action=a)
-            self.children.append(child_node)
-        return True
+        # all child states in 1 gather, and all rewards in 1 batch
+        codes = [ROTATE_CODES[a] for a in self.possible_actions]
+        states = self.state.cube.reshape(54)[ROTATE_TABLE[codes]]
+        if table is None :
+            rewards = get_reward(states)
+            for a, s, r in zip(self.possible_actions, states, rewards.tolist()) :
+                child_node = TreeHorn(Cube.from_state(s), parent=self, parent_action=a, reward=r)
+                self.children.append(child_node)
+            return True
+
+        actions = []
+        new = []
+        for a, s, key in zip(self.possible_actions, states, state_key(states)) :
+            node = table.nodes.get(key)
+            if node is None :
+                new.append((a, s, key))
+                continue
+            table.hits += 1
+            if not self.has_ancestor(node) :
+                if node.more_parents is None :
+                    node.more_parents = []
+                node.more_parents.append(self)
+                actions.append(a)
+                self.children.append(node)
+                if node.children and node.best_reward > self.best_reward :
+                    # an expanded node's parents have at least its best_reward (see backpropagate),
+                    # this one gets it with the backpropagation from here
+                    self.best_reward = node.best_reward
+        if new :
+            rewards = table.get_rewards([key for (a, s, key) in new], np.stack([s for (a, s, key) in new]))
+            for (a, s, key), r in zip(new, rewards) :
+                child_node = TreeHorn(Cube.from_state(s), parent=self, parent_action=a, reward=r)
+                table.nodes[key] = child_node
+                actions.append(a)
+                self.children.append(child_node)
+        self.possible_actions = actions
+        return len(self.children) > 0
+
+    def detach(self, table=None) :
+        """
+        Remove a dead end node from all its parents, and any parent left without children.
+        """
+        for p in list(self.parents()) :
+            i = p.children.index(self)
+            del p.children[i]
+            p.possible_actions = p.possible_actions[:i] + p.possible_actions[i+1:]
+            if not p.children and not p.is_root_node() :
+                p.detach(table)
+        self.stats.nodes -= 1
+        self.parent = None
+        self.more_parents = None
+        if table is not None :
+            table.remove(self)
+
+    def unlink_parent(self, p) :
+        # remove parent p, the next parent (if any) becomes the first parent
+        if self.parent is p :
+            if self.more_parents :
+                self.parent = self.more_parents.pop()
+                self.parent_action = self.parent.action_to(self)
+            else :
+                self.parent = None
+        else :
+            self.more_parents.remove(p)
+        if not self.more_parents :
+            self.more_parents = None
+
+    def collapse(self, table=None) :
+        """
+        Remove all the nodes below this one, so it is a leaf again (and expanded again if selected).
+        best_reward and num_visits keep the statistics of the removed subtree.
+        Nodes also reached from outside the subtree (transpositions) are kept.
+        """
+        stack = [self]
+        while stack :
+            n = stack.pop()
+            for c in n.children :
+                c.unlink_parent(n)
+                if c.parent is None :
+                    self.stats.nodes -= 1
+                    if table is not None :
+                        table.remove(c)
+                    stack.append(c)
+            n.children = []
+        self.possible_actions = self.state.get_possible_actions(self.parent_action)
 
 ###
 ###  Everything from here down should be outside the class definition.
@@ -114,7 +310,7 @@ def softmax( X : np.array, theta=1) :
     X = X / theta
     return(np.exp(X - np.max(X)) / np.exp(X - np.max(X)).sum())
 
-def best_child(node : TreeHorn, explore_param=0.0):
+def best_child(node : TreeHorn, explore_param=0.0, virtual_loss=0.0):
     """
     Find a child node to explore, using exploitation vs exploration
 
@@ -122,6 +318,8 @@ def best_child(node : TreeHorn, explore_param=0.0):
     # low values of theta will generate less randomness (exploit vs explore)
     # higher values will select more random nodes (explore vs exploit)
     # No further parameters needed to control exploit vs explore !
+    # virtual_loss is taken off the reward for each pending selection through a child,
+    # so selections made before their rollouts are back spread out over the tree.
     # TO DO: consider weighing by number of visits.
     # Testing : adjust the softmax temp to favour exploration 
     for cubes with higher entropy.
@@ -129,7 +327,10 @@ def best_child(node : TreeHorn, explore_param=0.0):
     if not node.children :
         raise Exception("Attempt to find best child of unexpanded node")
 
-    child_rewards = np.array( [(c.best_reward) for c in node.children] )
+    if virtual_loss :
+        child_rewards = np.array( [(c.best_reward - virtual_loss * c.pending) for c in node.children] )
+    else :
+        child_rewards = np.array( [(c.best_reward) for c in node.children] )
 
     if explore_param == 0 :
         # full exploit
@@ -140,116 +341,694 @@ def best_child(node : TreeHorn, explore_param=0.0):
         rand_child = np.random.choice(len(node.children), p=weights)
         return node.children[rand_child]
 
-def tree_policy(node : TreeHorn, explore_param:float):
+def tree_policy(node : TreeHorn, explore_param:float, table=None, virtual_loss=0.0, path=None):
     """
     select the next node for rollout.  Search recursively down the tree using "best child".
     when we get to an unexpanded node, expand it and return.
+    If a path list is given, the nodes on the way down (root to leaf) are appended to it.
     """
 
     current_node = node
+    if path is not None :
+        path.append(current_node)
     while current_node.is_fully_expanded() :  # go recursively down the tree
-        current_node = best_child(current_node, explore_param)
+        current_node = best_child(current_node, explore_param, virtual_loss)
+        if path is not None :
+            path.append(current_node)
 
-    current_node.expand()
+    current_node.expand(table)
 
     return current_node
 
 
-def backpropagate(node : TreeHorn, reward):
+def backpropagate(node : TreeHorn, reward, path=None):
     """
     Backpropogate the best reward from this node to parent(s)
-            
+    In a DAG (with a transposition table) every ancestor is updated once.
+    Stops going up at a parent whose best_reward is already at least the reward:
+    its ancestors have at least its best_reward too.
+    num_visits is counted on path, the nodes from the root selected on the way down 
+    (default: the first parents).
     """
-    node.num_visits += 1.
+    if path is None :
+        path = [node]
+        while path[-1].parent is not None :
+            path.append(path[-1].parent)
+    for p in path :
+        p.num_visits += 1.
+
     if reward > node.best_reward :
         node.best_reward = reward
-    if node.parent:
-        backpropagate(node.parent, node.best_reward)
+    reward = node.best_reward
+    stack = list(node.parents())
+    seen = set()
+    while stack :
+        p = stack.pop()
+        if p.best_reward >= reward or id(p) in seen :
+            continue
+        seen.add(id(p))
+        p.best_reward = reward
+        stack.extend(p.parents())
+
+# bytes per TreeHorn node with its Cube: about 565, measured with tracemalloc on an 80,000 node tree,
+# plus some margin
+NODE_BYTES = 600
+
+def prune_tree(root : TreeHorn, node_budget, table=None, keep=0.8) :
+    """
+    Collapse the least promising subtrees, lowest best_reward first then fewest num_visits,
+    until the tree has at most keep * node_budget nodes.  
+    Pruning to less than the budget means it is not needed again for a while.
+    Returns the number of nodes removed.
+    """
+    target = int(node_budget * keep)
+    before = root.stats.nodes
+    if before <= target :
+        return 0
+    expanded = []
+    seen = {id(root)}
+    stack = list(root.children)
+    while stack :
+        n = stack.pop()
+        if id(n) in seen :
+            continue
+        seen.add(id(n))
+        if n.children :
+            expanded.append(n)
+            stack.extend(n.children)
+    expanded.sort(key=lambda n : (n.best_reward, n.num_visits))
+    for n in expanded :
+        if root.stats.nodes <= target :
+            break
+        if n.children : # not removed with an earlier subtree
+            n.collapse(table)
+    return before - root.stats.nodes
 
-def rollout(node : TreeHorn, queue_in, queue_out):
+def rollout(node : TreeHorn, pool, table=None, depth=1, early_exit=False):
     """
     This will normally simulate the game until it finds a solved state.
     However, for the cube problem, we will only simulate the next leve.
     i.e. we just need to get the reward for the best child.
     
-    May be improved by searching down 2-3 layers for best reward, 
-    if this can be done cheaply.
+    depth: each child is scored with the best reward of all the states up to depth rotations
+    below it (see rollout_sequences).
+    early_exit: if a rollout state is solved, give that child reward 1 without scoring the rest.
+
+    The rollout states of all children are sent to the pool as 1 request.
+    With a transposition table, positions that are already known are not sent.
+    """
+    return rollout_result(node, rollout_submit(node, pool, table, depth, early_exit), pool, table)
+
+def rollout_submit(node : TreeHorn, pool, table=None, depth=1, early_exit=False):
+    """
+    First half of rollout: send the rollout states to the pool and return without waiting.
+    Returns the request to pass to rollout_result.
     """
     if node.is_terminal_node() or (not node.children):
         raise Exception('Attempt to rollout from solved cube')
         
+    sent = []
+    leaves = []
+    sent_keys = []
     for c in node.children :
-        c.best_reward = deep_rollout(c, queue_in, queue_out)
+        states = c.state.cube.reshape(54)[rollout_perms(c.parent_action, depth)]
+        if early_exit and (states == SOLVED_STATE).all(axis=1).any() :
+            update_child_reward(c, 1.0)
+            return None
+        if table is not None :
+            states, keys, known = table.lookup_states(states)
+            if known :
+                update_child_reward(c, max(known))
+            if not len(states) :
+                continue
+            sent_keys.append(keys)
+        sent.append(c)
+        leaves.append(states)
+    if not sent :
+        return None
+    req_id = pool.submit(np.concatenate(leaves))
+    return (req_id, sent, [len(s) for s in leaves], sent_keys)
+
+def rollout_result(node : TreeHorn, request, pool, table=None):
+    """
+    Second half of rollout: wait for the rewards, update the children and 
+    return the reward for the node.
+    """
+    if request is not None :
+        req_id, sent, counts, sent_keys = request
+        rewards = pool.result(req_id)
+        for i, (c, r) in enumerate(zip(sent, np.split(rewards, np.cumsum(counts)[:-1]))) :
+            update_child_reward(c, r.max())
+            if table is not None :
+                table.add_rewards(sent_keys[i], r)
 
     best = best_child(node, explore_param=0.0)
 
     return best.reward
 
-def deep_rollout(node : TreeHorn, queue_in, queue_out) :
+def update_child_reward(c : TreeHorn, reward) :
+    # a rollout reward for a child.  Children are new leaves, except with a transposition table
+    # where an expanded node can be linked as a child: then its parents are updated too.
+    if reward > c.best_reward :
+        if c.children :
+            backpropagate(c, reward, path=[])
+        else :
+            c.best_reward = reward
+
+def rollout_sequences(last_action, depth=1) :
     """
-    Explore moves from current cube state and return best reward.
-    TO DO: eliminate redundant rotations
+    Rotation sequences of 1 to depth rotations to explore in a rollout, from a node reached 
+    with last_action.
+    Each rotation is one of the SUCCESSORS of the one before, so each state is reached once.
+    About 13.5, 180 and 2,400 sequences of each length.
     """
-    
-    possible_actions = node.state.get_possible_actions(node.parent_action)
-    all_actions = node.state.get_possible_actions()
-    moves2 = [[r1,r2] for r1 in possible_actions for r2 in all_actions if r1[0] != r2[0]]
-#    moves = [[a] for a in possible_actions] + moves2
-    moves = [[a] for a in possible_actions] 
-
-    start_state = deepcopy(node.state.cube)
-    for m in moves :
-        queue_in.put((start_state,m))
-    rewards = [node.best_reward]
-    for m in moves:
-        reward = queue_out.get() # get will wait for each return value
-        rewards.append(reward) 
-    best_reward = max(rewards)
-    node.best_reward = best_reward
-
-    return best_reward
+    level = [[r] for r in SUCCESSORS.get(last_action, SUCCESSORS[None])]
+    sequences = []
+    for d in range(depth) :
+        sequences += level
+        if d + 1 < depth :
+            level = [s + [r] for s in level for r in SUCCESSORS[s[-1]]]
+    return sequences
+
+_ROLLOUT_PERMS = {}
+
+def rollout_perms(last_action, depth=1) :
+    # rollout_sequences as (N, 54) facelet permutations, built once for each last action and depth
+    key = (last_action, depth)
+    if key not in _ROLLOUT_PERMS :
+        _ROLLOUT_PERMS[key] = np.stack([compose_moves(s) for s in rollout_sequences(last_action, depth)])
+    return _ROLLOUT_PERMS[key]
+
+class TranspositionTable :
+    """
+    Positions already seen by the search, keyed by cube.state_key (27 bytes).
+    nodes: position -> tree node, so that expand() links repeated positions instead of
+        building a second subtree.
+    rewards: position -> reward, for positions scored by rollouts or by expand(), so they are 
+        not scored again.  Limited to max_rewards entries, after that it is not extended.
+    The rewards are not shared between symmetric positions (cube.canonical_key): the distance 
+    estimate is not symmetry invariant, and canonical keys cost much more than the reward.
+    """
+
+    def __init__(self, max_rewards=1000000) :
+        self.nodes = {}
+        self.rewards = {}
+        self.max_rewards = max_rewards
+        self.hits = 0
+
+    def __len__(self) :
+        return len(self.nodes)
+
+    def add(self, node : TreeHorn) :
+        self.nodes[state_key(node.state.cube)] = node
+
+    def remove(self, node : TreeHorn) :
+        key = state_key(node.state.cube)
+        if self.nodes.get(key) is node :
+            del self.nodes[key]
+
+    def known_reward(self, key) :
+        # reward of a position if it has already been scored, or None
+        node = self.nodes.get(key)
+        if node is not None :
+            return node.reward
+        return self.rewards.get(key)
+
+    def add_rewards(self, keys, rewards) :
+        if len(self.rewards) < self.max_rewards :
+            self.rewards.update(zip(keys, rewards.tolist()))
+
+    def get_rewards(self, keys, states) :
+        """
+        Rewards for an (N, 54) array of states, scoring only the ones not seen before.
+        """
+        rewards = [self.rewards.get(k) for k in keys]
+        missing = [i for i, r in enumerate(rewards) if r is None]
+        if missing :
+            scored = get_reward(states[missing])
+            self.add_rewards([keys[i] for i in missing], scored)
+            for i, r in zip(missing, scored.tolist()) :
+                rewards[i] = r
+        self.hits += len(keys) - len(missing)
+        return rewards
+
+    def lookup_states(self, states) :
+        """
+        Split rollout states (N, 54) into the unknown positions, with their keys,
+        and the rewards of known positions.
+        """
+        keys = state_key(states)
+        unknown = []
+        unknown_keys = []
+        known = []
+        for i, k in enumerate(keys) :
+            r = self.known_reward(k)
+            if r is None :
+                unknown.append(i)
+                unknown_keys.append(k)
+            else :
+                known.append(r)
+        self.hits += len(known)
+        return states[unknown], unknown_keys, known
+
+class StateArena :
+    """
+    Shared memory for rollouts: a ring of n_slots cube states (uint8, 54 each) and 
+    1 float reward slot per state slot.
+    The search process writes states into a range of slots, a worker reads them and writes 
+    the rewards into the same range, so only slot numbers go through the queues.
+    The search process owns the arena and unlinks it on close, workers attach to it by name.
+    """
+
+    def __init__(self, n_slots=1<<16, name=None) :
+        self.n_slots = n_slots
+        if name is None :
+            self.shm = shared_memory.SharedMemory(create=True, size=n_slots * (8 + 54))
+            self.owner = True
+        else :
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self.shm.name
+        self.rewards = np.ndarray((n_slots,), dtype=np.float64, buffer=self.shm.buf)
+        self.states = np.ndarray((n_slots, 54), dtype=np.uint8, buffer=self.shm.buf, offset=n_slots * 8)
+        self.head = 0 # next free slot
+        self.in_flight = {} # (req_id, part) -> (start, count)
+
+    def allocate(self, count) :
+        """
+        First slot of count free slots after the head (wrapping round to 0),
+        or None while some of them are still in flight.
+        """
+        if count > self.n_slots :
+            raise Exception(f"Batch of {count} states is bigger than the arena ({self.n_slots} slots)")
+        start = self.head if self.head + count <= self.n_slots else 0
+        for s, n in self.in_flight.values() :
+            if s < start + count and start < s + n :
+                return None
+        return start
+
+    def close(self) :
+        del self.rewards, self.states
+        self.shm.close()
+        if self.owner :
+            self.shm.unlink()
 
 class Worker(mp.Process):
-    def __init__(self, queue_in, queue_out):
+    """
+    Scores rollouts for a SolverPool.
+    Job: (req_id, part, start, count) to score the states in arena slots start to start+count,
+    or None to stop.  Reply: (req_id, part) once the rewards are in the same slots.
+    Also stops if the process that started it has died (a daemon is only stopped by a clean exit).
+    """
+    def __init__(self, queue_in, queue_out, arena_name, n_slots, pattern_db=None):
         super().__init__(daemon=True)
         self.queue_in = queue_in
         self.queue_out = queue_out
-        self.play_cube = Cube()
+        self.arena_name = arena_name
+        self.n_slots = n_slots
+        # rewards from the same pattern database as the search (pickled as paths, then memory-mapped)
+        self.pattern_db = pattern_db
 
     def run(self):
+        Cube.pattern_db = self.pattern_db
+        arena = StateArena(self.n_slots, name=self.arena_name)
+        parent = mp.parent_process()
+        while True :
+            try :
+                job = self.queue_in.get(timeout=1)
+            except queue.Empty :
+                if parent is not None and not parent.is_alive() :
+                    break
+                continue
+            if job is None : # shutdown
+                break
+            (req_id, part, start, count) = job
+            arena.rewards[start:start+count] = get_reward(arena.states[start:start+count])
+            self.queue_out.put((req_id, part))
+        arena.close()
+
+class SolverPool :
+    """
+    Rollout workers for mcts_search, started once and reused by many searches.
+    Use as a context manager so the workers are shut down cleanly:
+        with SolverPool(n_workers=8) as pool :
+            mcts_search(root, pool=pool)
+
+    Work is sent as requests: submit() copies a batch of states into the shared StateArena,
+    splits it into at most n_workers parts of at least chunk_size states, 
+    and sends 1 small message per part.
+    Replies carry the request id and part number, so result() can wait for 1 request while
+    the rewards of other requests are kept until they are asked for.
+    When the arena is full, submit() waits for replies to free the slots, and a batch bigger
+    than the arena is sent in pieces, so there is no limit on the rollout_depth.
+    """
+
+    def __init__(self, n_workers=8, pattern_db=None, chunk_size=64, n_slots=1<<16) :
+        self.n_workers = n_workers
+        self.chunk_size = chunk_size
+        self.queue_in = mp.Queue()
+        self.queue_out = mp.Queue()
+        self.arena = StateArena(n_slots)
+        self.next_id = 0
+        self.requests = {} # req_id -> number of parts
+        self.replies = {} # req_id -> {part : rewards}
+        if pattern_db is None :
+            pattern_db = Cube.pattern_db
+        self.workers = [Worker(self.queue_in, self.queue_out, self.arena.name, n_slots, pattern_db) 
+                        for _ in range(n_workers)]
+        for worker in self.workers :
+            worker.start()
+
+    def receive(self) :
+        # wait for 1 reply, copy its rewards out of the arena and free the slots
         while True :
-            (cube_state, move) = self.queue_in.get()
-            self.play_cube.cube = cube_state
-            self.play_cube.move(move)
-            reward = self.play_cube.get_reward()
-            self.queue_out.put(reward)
+            try :
+                req_id, part = self.queue_out.get(timeout=1)
+                break
+            except queue.Empty :
+                # a worker that died (e.g. killed out of memory) never replies
+                if not self.is_alive() :
+                    dead = [w.exitcode for w in self.workers if not w.is_alive()]
+                    raise Exception(f"Rollout worker exited with code {dead[0]}")
+        start, count = self.arena.in_flight.pop((req_id, part))
+        self.replies[req_id][part] = self.arena.rewards[start:start+count].copy()
+
+    def submit(self, states) :
+        """
+        Start scoring the states (N, 54).  Returns the request id for result().
+        A batch bigger than the arena is sent in arena-sized pieces.
+        """
+        states = np.asarray(states, dtype=np.uint8).reshape(-1, 54)
+        req_id = self.next_id
+        self.next_id += 1
+        self.requests[req_id] = 0
+        self.replies[req_id] = {}
+        for lo in range(0, max(len(states), 1), self.arena.n_slots) :
+            self.submit_piece(req_id, states[lo:lo+self.arena.n_slots])
+        return req_id
+
+    def submit_piece(self, req_id, states) :
+        # copy states into the arena and send them as parts of request req_id
+        start = self.arena.allocate(len(states))
+        while start is None :
+            self.receive()
+            start = self.arena.allocate(len(states))
+        self.arena.states[start:start+len(states)] = states
+        self.arena.head = start + len(states)
+
+        n_parts = max(1, min(self.n_workers, len(states) // self.chunk_size))
+        bounds = np.linspace(0, len(states), n_parts + 1).astype(int)
+        first = self.requests[req_id]
+        self.requests[req_id] += n_parts
+        for part in range(n_parts) :
+            lo, hi = start + bounds[part], start + bounds[part+1]
+            self.arena.in_flight[(req_id, first + part)] = (lo, hi - lo)
+            self.queue_in.put((req_id, first + part, lo, hi - lo))
+
+    def result(self, req_id) :
+        """
+        Wait for a request.  Returns the (N,) rewards.
+        """
+        n_parts = self.requests.pop(req_id)
+        while len(self.replies[req_id]) < n_parts :
+            self.receive()
+        replies = self.replies.pop(req_id)
+        return np.concatenate([replies[p] for p in range(n_parts)])
+
+    def map_rewards(self, states) :
+        return self.result(self.submit(states))
+
+    def is_alive(self) :
+        # False if a worker has died: its requests will never be answered
+        return all(w.is_alive() for w in self.workers)
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) :
+        self.close()
+
+    def close(self, timeout=5) :
+        if not self.workers :
+            return
+        for _ in self.workers :
+            self.queue_in.put(None)
+        for worker in self.workers :
+            worker.join(timeout)
+            if worker.is_alive() :
+                worker.terminate()
+                worker.join()
+            worker.close()
+        self.workers = []
+        for q in (self.queue_in, self.queue_out) :
+            q.close()
+            q.join_thread()
+        self.arena.close()
 
 
-def mcts_search(node, iterations=100, explore_param=0.05):
+def reroot(root : TreeHorn, child : TreeHorn, table=None) :
+    """
+    Commit to the move from root to child: child becomes the root of the tree, with its subtree
+    and statistics kept, so mcts_search can continue from it.
+    The rest of the tree is freed, and removed from the transposition table.
+    Returns the new root.
+    """
+    if child not in root.children :
+        raise Exception("Attempt to re-root at a node that is not a child of the root")
+    child.state.moves = root.state.moves + [root.action_to(child)]
+
+    # the subtree, breadth first, with depths from the new root
+    child.depth = 0
+    keep = {id(child)}
+    order = [child]
+    for n in order :
+        for c in n.children :
+            if id(c) not in keep :
+                keep.add(id(c))
+                c.depth = n.depth + 1
+                order.append(c)
+    for n in order :
+        for p in list(n.parents()) :
+            if id(p) not in keep :
+                n.unlink_parent(p)
+
+    # free the rest: break the parent/children links so it is released at once
+    stack = [root]
+    seen = set()
+    while stack :
+        n = stack.pop()
+        if id(n) in seen or id(n) in keep :
+            continue
+        seen.add(id(n))
+        stack.extend(n.children)
+        n.children = []
+        n.parent = None
+        n.more_parents = None
+    if table is not None :
+        for key in [k for k, n in table.nodes.items() if id(n) not in keep] :
+            del table.nodes[key]
+
+    stats = TreeStats(child.reward)
+    stats.created = root.stats.created
+    stats.solved = bool(child.reward == 1)
+    for n in order :
+        n.stats = stats
+    for n in order[1:] :
+        stats.add(n)
+    stats.created = root.stats.created
+    return child
+
+class SearchResult :
+    """
+    Result of mcts_search.  True if solved, so it can be used as the old boolean result.
+    solved: a solved node was found
+    moves: rotations from the root state to solved ([] if not solved)
+    best_path: rotations from the root state to the best node found (= moves if solved)
+    distance: estimated rotations still to go after best_path (0 if solved)
+    iterations: iterations done, nodes: nodes created, elapsed: seconds
+    """
+
+    def __init__(self, solved, best_path, distance, iterations, nodes, elapsed) :
+        self.solved = bool(solved)
+        self.moves = best_path if solved else []
+        self.best_path = best_path
+        self.distance = distance
+        self.iterations = iterations
+        self.nodes = nodes
+        self.elapsed = elapsed
+
+    def __bool__(self) :
+        return self.solved
+
+    def __repr__(self) :
+        return (f'SearchResult(solved={self.solved}, moves={self.moves}, best_path={self.best_path}, '
+                f'distance={self.distance:.1f}, iterations={self.iterations}, nodes={self.nodes}, '
+                f'elapsed={self.elapsed:.2f})')
+
+def mcts_search(node, iterations=100, explore_param=0.05, table=None, pool=None, batch_size=1, virtual_loss=0.05,
+                node_budget=None, byte_budget=None, deadline=None, max_nodes=None, rollout_depth=1, 
+                early_exit=False, stop=None):
     """
     pick a node, find a possible reward, backpropogate.
     repeat n times, and then return the best child.
+    Pass a TranspositionTable to share nodes and rewards between identical positions.
+    Pass a SolverPool to reuse its workers, otherwise a pool is started and shut down for this search.
+
+    Tree-parallel search: with batch_size > 1, up to batch_size leaves are selected and
+    their rollouts sent to the pool before waiting for any of them, so the workers score
+    rollouts from different leaves at the same time.  While a leaf waits for its rollout,
+    virtual_loss is taken off the reward of every node on its path for the next selections.
+    Each leaf counts as 1 of the iterations.
+
+    Memory budget: with node_budget (number of nodes) or byte_budget (estimated as NODE_BYTES 
+    per node), the least promising subtrees are collapsed into their top node when the tree
+    gets bigger than the budget, see prune_tree.
+
+    Anytime search: stops at the first of iterations (None for no limit), deadline 
+    (a time.time() value), max_nodes (nodes created) or solved.  The limits are checked between 
+    steps, so a step of batch_size leaves can go over them.
+    Returns a SearchResult with the best path found so far if not solved.
+
+    rollout_depth, early_exit: see rollout.  Deeper rollouts need fewer iterations but score
+    about 14x more states per extra rotation.
+    stop: function checked with the deadline before each step, the search stops when it returns True.
+    """
+    if pool is None :
+        with SolverPool() as pool :
+            return mcts_search(node, iterations, explore_param, table, pool, batch_size, virtual_loss,
+                               node_budget, byte_budget, deadline, max_nodes, rollout_depth, early_exit, stop)
+
+    search = Search(node, iterations, explore_param, table, pool, batch_size, virtual_loss,
+                    node_budget, byte_budget, deadline, max_nodes, rollout_depth, early_exit, stop)
+    while search.select() :
+        search.collect()
+    return search.result()
+
+class Search :
+    """
+    The loop of mcts_search as 2 steps, so several searches can share 1 pool:
+    select() picks up to batch_size leaves and sends their rollouts to the pool without waiting,
+    collect() waits for those rollouts and backpropagates them.
+    select() returns False when the search is over, then result() is its SearchResult.
     """
-    
-    queue_in = mp.Queue()
-    queue_out = mp.Queue()
-
-    workers = [
-        Worker(queue_in, queue_out)
-        for _ in range(8) ### Number of workers ###
-    ]
-    for worker in workers:
-        worker.start()
-    
-    for i in range(iterations):
-        v = tree_policy(node, explore_param) # get a node to try
-        reward = rollout(v, queue_in, queue_out) # possible reward from that node
-        backpropagate(v, reward)
-        if node.best_reward==1 :
-            break
 
-#    for worker in workers:
-#        worker.terminate()
-#        worker.close()
-	
-    return (node.best_reward==1)
+    def __init__(self, node, iterations=100, explore_param=0.05, table=None, pool=None, batch_size=1, 
+                 virtual_loss=0.05, node_budget=None, byte_budget=None, deadline=None, max_nodes=None, 
+                 rollout_depth=1, early_exit=False, stop=None) :
+        self.node = node
+        self.iterations = np.inf if iterations is None else iterations
+        self.explore_param = explore_param
+        self.table = table
+        self.pool = pool
+        self.batch_size = batch_size
+        self.virtual_loss = virtual_loss
+        self.node_budget = node_budget
+        if byte_budget is not None :
+            self.node_budget = min(node_budget or np.inf, byte_budget // NODE_BYTES)
+        self.deadline = deadline
+        self.max_nodes = max_nodes
+        self.rollout_depth = rollout_depth
+        self.early_exit = early_exit
+        self.stop = stop
+        if table is not None :
+            table.add(node)
+        self.stats = node.stats
+        self.created = self.stats.created
+        self.i = 0
+        self.selected = []
+        self.tic = time.time()
+
+    def select(self) :
+        stats = self.stats
+        if self.i >= self.iterations or stats.solved :
+            return False
+        if self.deadline is not None and time.time() > self.deadline :
+            return False
+        if self.stop is not None and self.stop() :
+            return False
+        if self.max_nodes is not None and stats.created - self.created >= self.max_nodes :
+            return False
+        if self.node_budget is not None and stats.nodes > self.node_budget :
+            prune_tree(self.node, self.node_budget, self.table)
+        selected = []
+        while len(selected) < self.batch_size and self.i < self.iterations :
+            self.i += 1
+            path = []
+            v = tree_policy(self.node, self.explore_param, self.table, self.virtual_loss, path) # get a node to try
+            if not v.children :
+                # every child is a repeat of a shorter path
+                if v.is_root_node() :
+                    break
+                v.detach(self.table)
+                continue
+            for p in path :
+                p.pending += 1
+            selected.append((v, path, rollout_submit(v, self.pool, self.table, self.rollout_depth, self.early_exit)))
+            if any(c.reward == 1 for c in v.children) :
+                break # solved, no need to select more
+        self.selected = selected
+        return bool(selected)
+
+    def collect(self) :
+        for v, path, request in self.selected :
+            reward = rollout_result(v, request, self.pool, self.table) # possible reward from that node
+            for p in path :
+                p.pending -= 1
+            backpropagate(v, reward, path)
+        self.selected = []
+
+    def result(self) :
+        stats = self.stats
+        return SearchResult(stats.solved, list(stats.best_moves), 10/stats.best_reward - 10, 
+                            self.i, stats.created - self.created, time.time() - self.tic)
+
+def solve_many(cubes, iterations=100000, pool=None, concurrency=None, time_limit=None, use_table=False, 
+               **search_args) :
+    """
+    Solve several cubes with interleaved searches on 1 SolverPool.
+    While 1 search selects and backpropagates, the rollouts of the others are in the pool,
+    so the workers are not idle between the steps of a search.
+    cubes: iterable of Cube, not changed.
+    concurrency: searches running at the same time (default 2 per worker).
+    time_limit: seconds per cube, from when its search starts.
+    use_table: give each search its own TranspositionTable.
+    search_args: passed to each search as in mcts_search (batch_size, explore_param, ...).
+    Yields (index of the cube, SearchResult) as each search ends, not in cube order.
+    """
+    if pool is None :
+        with SolverPool() as pool :
+            yield from solve_many(cubes, iterations, pool, concurrency, time_limit, use_table, **search_args)
+        return
+    if concurrency is None :
+        concurrency = 2 * pool.n_workers
+    cubes = enumerate(cubes)
+    running = deque()
+    finished = []
+
+    def start() :
+        # start the next cube, returns False when there are none left
+        for i, cube in cubes :
+            root = TreeHorn(Cube.from_state(cube.cube.copy()))
+            deadline = None if time_limit is None else time.time() + time_limit
+            search = Search(root, iterations, table=TranspositionTable() if use_table else None, pool=pool,
+                            deadline=deadline, **search_args)
+            if search.select() :
+                running.append((i, search))
+            else :
+                finished.append((i, search.result()))
+            return True
+        return False
+
+    while True :
+        while len(running) < concurrency and start() :
+            pass
+        yield from finished
+        finished.clear()
+        if not running :
+            break
+        i, search = running.popleft()
+        search.collect()
+        if search.select() :
+            running.append((i, search))
+        else :
+            finished.append((i, search.result()))
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pattern databases: exact distance to solve a subproblem of the cube, e.g. only the corners,
+or only 6 of the edges, ignoring all other cubies.
+The distance for a subproblem is never more than the distance for the whole cube,
+so the max over several tables is an admissible heuristic (a lower bound on rotations to solve).
+
+Builder: breadth-first search over the subproblem, from the solved state,
+    written to disk as a packed table with a 4-bit nibble per entry.
+Loader: np.memmap of the table, so many worker processes share 1 read-only copy.
+
+The default set is the corners (88,179,840 entries, 44 MB) and 2 groups of 6 edges
+(42,577,920 entries, 21 MB each).  Build them once with:
+    python pattern_db.py
+
+"""
+
+#%% Packages
+import numpy as np
+import os
+import time
+from cube import Cube, CP_MOVE, CO_MOVE, EP_MOVE, EO_MOVE, VALID_ROTATES, facelets_to_cubies
+
+#%% Subproblems
+
+UNKNOWN = 15 # nibble value for entries not reached (yet)
+
+class Pattern :
+    """
+    A subproblem: the position and orientation of some of the corners or some of the edges.
+    kind: 'corners' or 'edges'
+    pieces: the tracked cubies, e.g. (0,1,2,3,4,5) for edges UR, UF, UL, UB, DR, DF
+
+    Index of a state = rank of the (ordered) positions of the tracked cubies * ori_base^k
+        + orientations of the tracked cubies in base ori_base (3 for corners, 2 for edges).
+    When all pieces are tracked the last orientation follows from the others and is left out.
+    """
+
+    def __init__(self, kind, pieces) :
+        if kind == 'corners' :
+            self.n, self.ori_base = 8, 3
+            self.perm_move, self.ori_move = CP_MOVE, CO_MOVE
+        elif kind == 'edges' :
+            self.n, self.ori_base = 12, 2
+            self.perm_move, self.ori_move = EP_MOVE, EO_MOVE
+        else :
+            raise Exception(f"Invalid pattern kind {kind}")
+        self.kind = kind
+        self.pieces = tuple(pieces)
+        self.k = len(self.pieces)
+        self.k_ori = self.k - 1 if self.k == self.n else self.k
+        # cubie in cubicle j moves to cubicle new_position[m, j]
+        self.new_position = np.argsort(self.perm_move, axis=1)
+        self.n_perm = int(np.prod(np.arange(self.n - self.k + 1, self.n + 1)))
+        self.n_ori = self.ori_base ** self.k_ori
+        self.size = self.n_perm * self.n_ori
+
+    def __repr__(self) :
+        return f"Pattern('{self.kind}', {self.pieces})"
+
+    def name(self) :
+        return f"{self.kind}_{'-'.join(str(p) for p in self.pieces)}"
+
+    def encode(self, pos, ori) :
+        # pos, ori : (N, k) cubicle and orientation of each tracked cubie -> (N,) index
+        idx = np.zeros(len(pos), dtype=np.int64)
+        for i in range(self.k) :
+            # rank of pos[:,i] among the cubicles not used by the earlier pieces
+            smaller = (pos[:, :i] < pos[:, i:i+1]).sum(axis=1)
+            idx = idx * (self.n - i) + pos[:, i] - smaller
+        for i in range(self.k_ori) :
+            idx = idx * self.ori_base + ori[:, i]
+        return idx
+
+    def decode(self, idx) :
+        # (N,) index -> pos, ori (N, k)
+        idx = np.array(idx, dtype=np.int64)
+        ori = np.zeros((len(idx), self.k), dtype=np.int64)
+        for i in range(self.k_ori - 1, -1, -1) :
+            idx, ori[:, i] = np.divmod(idx, self.ori_base)
+        if self.k_ori < self.k :
+            ori[:, -1] = -ori[:, :-1].sum(axis=1) % self.ori_base
+        digits = np.zeros((len(idx), self.k), dtype=np.int64)
+        for i in range(self.k - 1, -1, -1) :
+            idx, digits[:, i] = np.divmod(idx, self.n - i)
+        pos = np.zeros((len(idx), self.k), dtype=np.int64)
+        free = np.ones((len(idx), self.n), dtype=bool)
+        rows = np.arange(len(idx))
+        for i in range(self.k) :
+            # the digits[:,i]-th free cubicle
+            pos[:, i] = np.argmax(np.cumsum(free, axis=1) > digits[:, i:i+1], axis=1)
+            free[rows, pos[:, i]] = False
+        return pos, ori
+
+    def apply(self, pos, ori, m) :
+        # apply rotation code m to the tracked cubies
+        new_pos = self.new_position[m][pos]
+        new_ori = (ori + self.ori_move[m][new_pos]) % self.ori_base
+        return new_pos, new_ori
+
+    def index_states(self, states) :
+        # (N, 54) facelet states -> (N,) index of this subproblem
+        cp, co, ep, eo = facelets_to_cubies(states)
+        perm, oris = (cp, co) if self.kind == 'corners' else (ep, eo)
+        pos = np.argmax(perm[:, None, :] == np.array(self.pieces)[None, :, None], axis=2)
+        ori = np.take_along_axis(oris, pos, axis=1).astype(np.int64)
+        return self.encode(pos, ori)
+
+DEFAULT_PATTERNS = (Pattern('corners', range(8)),
+                    Pattern('edges', range(0,6)),
+                    Pattern('edges', range(6,12)))
+
+#%% Builder
+
+def build_table(pattern : Pattern, chunk=1<<20, verbose=True) :
+    """
+    Breadth-first search over all states of the subproblem, from solved.
+    Returns a uint8 array of distances, 1 per index.
+    The frontier at each depth is found by scanning the table, so memory is the table plus 1 chunk.
+    """
+    dist = np.full(pattern.size, UNKNOWN, dtype=np.uint8)
+    solved = pattern.encode(np.array([pattern.pieces]), np.zeros((1, pattern.k), dtype=np.int64))
+    dist[solved] = 0
+    depth = 0
+    tic = time.time()
+    while True :
+        frontier = np.flatnonzero(dist == depth)
+        if len(frontier) == 0 :
+            break
+        if verbose :
+            print(f'{pattern.name()}: depth {depth}, {len(frontier):,} states, {time.time()-tic:.0f}s')
+        if depth + 1 >= UNKNOWN :
+            raise Exception("Pattern too deep for 4-bit entries")
+        for start in range(0, len(frontier), chunk) :
+            pos, ori = pattern.decode(frontier[start:start+chunk])
+            for m in range(len(VALID_ROTATES)) :
+                idx = pattern.encode(*pattern.apply(pos, ori, m))
+                idx = idx[dist[idx] == UNKNOWN]
+                dist[idx] = depth + 1
+        depth += 1
+    return dist
+
+def pack_nibbles(dist) :
+    # 2 entries per byte: even index in the low nibble
+    if len(dist) % 2 :
+        dist = np.append(dist, UNKNOWN)
+    return (dist[0::2] | (dist[1::2] << 4)).astype(np.uint8)
+
+def table_path(pattern : Pattern, directory='pdb') :
+    return os.path.join(directory, pattern.name() + '.npy')
+
+def build(patterns=DEFAULT_PATTERNS, directory='pdb', verbose=True) :
+    """
+    Build and save the tables that do not exist yet.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for p in patterns :
+        path = table_path(p, directory)
+        if os.path.exists(path) :
+            continue
+        packed = pack_nibbles(build_table(p, verbose=verbose))
+        np.save(path + '.tmp.npy', packed)
+        os.replace(path + '.tmp.npy', path)
+    return True
+
+#%% Loader
+
+class PatternDatabase :
+    """
+    Read-only memory-mapped tables.  The OS page cache shares them between processes,
+    and pickling only sends the paths, so workers map the same files.
+    heuristic(states) is the max distance over all tables: admissible, 0 only when solved
+    (if the patterns cover all cubies).
+    """
+
+    def __init__(self, patterns=DEFAULT_PATTERNS, directory='pdb') :
+        self.patterns = tuple(patterns)
+        self.directory = directory
+        self.tables = [np.load(table_path(p, directory), mmap_mode='r') for p in self.patterns]
+
+    def __getstate__(self) :
+        return ([(p.kind, p.pieces) for p in self.patterns], self.directory)
+
+    def __setstate__(self, state) :
+        patterns, directory = state
+        self.__init__([Pattern(kind, pieces) for kind, pieces in patterns], directory)
+
+    def lookup(self, pattern_no, states) :
+        idx = self.patterns[pattern_no].index_states(states)
+        packed = self.tables[pattern_no][idx >> 1]
+        return (packed >> ((idx & 1) * 4).astype(np.uint8)) & 0x0F
+
+    def heuristic(self, states) :
+        """
+        Lower bound on the rotations to solve each state in an (N, 54) batch (or 1 state).
+        """
+        states = np.asarray(states).reshape(-1, 54)
+        h = np.zeros(len(states), dtype=np.uint8)
+        for i in range(len(self.tables)) :
+            h = np.maximum(h, self.lookup(i, states))
+        return h
+
+def use_for_rewards(db) :
+    """
+    Make the pattern database the distance estimate behind Cube.get_reward, cube.get_reward
+    and update_entropy('pdb').  Pass None to go back to the entropy blend.
+    """
+    Cube.pattern_db = db
+
+#%% Main
+
+if __name__ == '__main__'  :
+    build()
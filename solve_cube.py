@@ -23,6 +23,26 @@ def inverse_move(moves) :
     inverse_rotates = inverse_rotates[::-1]
     return inverse_rotates
 
+def solve_stepwise(root, pool, step_iterations=1000, max_steps=30, table=None, **search_args) :
+    """
+    Incremental solver: search from the root, commit to the best move, re-root the tree at 
+    that child (keeping its subtree) and search again.
+    Yields each move as it is committed, and then the rest of the solution once it is found.
+    search_args are passed to mcts.mcts_search.
+    """
+    for step in range(max_steps) :
+        result = mcts.mcts_search(root, iterations=step_iterations, table=table, pool=pool, **search_args)
+        if result.solved :
+            yield from result.moves
+            return
+        if not root.children :
+            return
+        child = mcts.best_child(root, explore_param=0.0)
+        yield root.action_to(child)
+        root = mcts.reroot(root, child, table)
+        if root.is_terminal_node() :
+            return
+
 #%% Solve
 
 if __name__ == '__main__'  :
@@ -30,6 +50,11 @@ if __name__ == '__main__'  :
     iterations = 100000
     explore_param = 0.05
     scrambles = 5
+    n_workers = 8
+    batch_size = n_workers # leaves selected per step (tree-parallel search)
+    time_limit = 15*60 # seconds
+    rollout_depth = 2 # rotations below each child scored in a rollout
+    step_iterations = 0 # > 0 to commit to 1 move every step_iterations (stepwise solver)
     
     rubiks = Cube()
     rubiks.move(rubiks.rand_move(scrambles))
@@ -37,22 +62,34 @@ if __name__ == '__main__'  :
     root = mcts.TreeHorn(rubiks)
     
     tic = time.time()
-    solved = mcts.mcts_search(root, iterations=iterations, explore_param=explore_param)
+    with mcts.SolverPool(n_workers=n_workers) as pool :
+        search_args = dict(explore_param=explore_param, batch_size=batch_size, 
+                           rollout_depth=rollout_depth, early_exit=True)
+        if step_iterations :
+            solve_moves = []
+            for m in solve_stepwise(root, pool, step_iterations, **search_args) :
+                print('Move: \t', m)
+                solve_moves.append(m)
+            check = Cube()
+            check.move(root.state.moves + solve_moves)
+            solved = check.is_solved()
+            best_path, distance = solve_moves, check.estimate_distance()
+        else :
+            result = mcts.mcts_search(root, iterations=iterations, pool=pool,
+                                      deadline=time.time() + time_limit, **search_args)
+            solved, solve_moves = result.solved, result.moves
+            best_path, distance = result.best_path, result.distance
+            print(root)
     toc = time.time()
     elapsed = toc-tic
     
     if solved :
         print('Cube solved!')
+        print('Solve moves: \t', solve_moves)
     else :
         print('Not solved!')
+        print(f'Best moves: \t {best_path}, about {distance:.1f} rotations still to go')
     print('Scramble moves: \t', root.state.moves)
     print('Reverse moves: \t', inverse_move(root.state.moves))
-    solve_moves = []
-    path = root
-    while path.is_fully_expanded() :
-        path = mcts.best_child(path, explore_param=0.0)
-        solve_moves.append(path.parent_action)
-    print('Solve moves: \t', solve_moves)
-    print(root)
     print(f'Working time: \t {int(elapsed/3600):01d}:{int(elapsed/60%60):02d}:{int(elapsed%60):02d}')
 
@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Solver service: accepts scramble requests over a local socket (JSON lines) or HTTP,
+queues them, runs them on a shared set of solver processes, and streams back progress
+and results.  The asyncio event loop only passes messages, the searches run in the
+solver processes (each with its own mcts.SolverPool of rollout workers).
+
+Request (1 JSON object):
+    {"id": "a1", "scramble": ["R1", "U2", ...]}      or "scramble": "R1 U2 ..."
+    {"id": "a2", "facelets": [54 colour numbers 0-5, face by face as Cube.cube]}
+    optional: "time_limit" (seconds, from when the request arrives), "engine" ("mcts",
+    "stepwise" or "ida"), and the search options in SEARCH_OPTIONS.
+    {"cancel": "a1"} cancels a request, queued or running.
+Replies (1 JSON object per line, all with the request id):
+    {"id", "status": "queued"}, {"id", "status": "started"},
+    {"id", "status": "progress", ...} (mcts: iterations, nodes, distance, best_path;
+        stepwise: each move as it is committed),
+    and finally 1 of {"id", "status": "done", "solved", "moves", "best_path", "distance", ...},
+    {"id", "status": "cancelled"} or {"id", "status": "error", "error"}.
+
+JSON lines: 1 request per line, any number per connection, the replies are interleaved.
+    Closing the connection cancels its requests.
+HTTP: POST /solve with 1 request as the body streams the replies (application/x-ndjson),
+    closing the connection cancels it.  GET /status returns the queue and solver counts.
+
+Run with:
+    python solver_service.py --port 8765 --http-port 8080 --solvers 2 --workers 4
+"""
+
+#%% Packages
+import argparse
+import asyncio
+import json
+import multiprocessing as mp
+import multiprocessing.connection
+import threading
+import time
+import numpy as np
+from cube import Cube, VALID_ROTATES
+import mcts
+import ida_star
+from solve_cube import solve_stepwise
+
+#%% Solver processes
+
+ENGINES = ('mcts', 'stepwise', 'ida')
+# request options passed on to the search, with their types
+SEARCH_OPTIONS = {'iterations' : int, 'explore_param' : float, 'batch_size' : int, 'rollout_depth' : int,
+                  'early_exit' : bool, 'step_iterations' : int, 'max_nodes' : int, 'table' : bool}
+
+class SolverProcess(mp.Process) :
+    """
+    Runs 1 search at a time.
+    Job: (job_no, state (54 uint8), engine, options, deadline), or None to stop.
+    Events: (job_no, status, payload dict) sent on the events pipe.
+    Setting cancel to a job_no stops that job at the next progress check.
+    Not a daemon, because it starts its own rollout workers.
+    """
+
+    def __init__(self, jobs, events, cancel, n_workers=4, progress_interval=1.0, pattern_db=None) :
+        super().__init__()
+        self.jobs = jobs
+        self.events = events
+        self.cancel = cancel
+        self.n_workers = n_workers
+        self.progress_interval = progress_interval
+        self.pattern_db = pattern_db
+
+    def run(self) :
+        Cube.pattern_db = self.pattern_db
+        pool = mcts.SolverPool(n_workers=self.n_workers)
+        try :
+            while True :
+                job = self.jobs.get()
+                if job is None :
+                    break
+                job_no = job[0]
+                self.events.send((job_no, 'started', {}))
+                try :
+                    status, payload = self.solve(pool, *job)
+                except Exception as e :
+                    status, payload = 'error', {'error' : str(e)}
+                self.events.send((job_no, status, payload))
+                if not pool.is_alive() :
+                    # a rollout worker died, start a new pool for the next job
+                    pool.close()
+                    pool = mcts.SolverPool(n_workers=self.n_workers)
+        finally :
+            pool.close()
+
+    def cancelled(self, job_no) :
+        return self.cancel.value == job_no
+
+    def solve(self, pool, job_no, state, engine, options, deadline) :
+        cube = Cube.from_state(state.copy())
+        tic = time.time()
+        if engine == 'ida' :
+            solved, moves = ida_star.ida_search(cube, max_nodes=options.get('max_nodes', 1000000),
+                                                deadline=deadline, pattern_db=Cube.pattern_db,
+                                                stop=lambda : self.cancelled(job_no))
+            if self.cancelled(job_no) :
+                return 'cancelled', {}
+            distance = 0.0 if solved else float(cube.estimate_distance())
+            return 'done', {'solved' : solved, 'moves' : moves, 'best_path' : moves,
+                            'distance' : distance, 'elapsed' : time.time() - tic}
+
+        table = mcts.TranspositionTable() if options.get('table') else None
+        search_args = {k : v for k, v in options.items() if k in ('explore_param', 'batch_size',
+                                                                  'rollout_depth', 'early_exit')}
+        # checked before each step of the search, so a cancel lands within 1 step
+        search_args['stop'] = lambda : self.cancelled(job_no)
+        root = mcts.TreeHorn(cube)
+        if engine == 'stepwise' :
+            moves = []
+            steps = solve_stepwise(root, pool, options.get('step_iterations', 1000), table=table,
+                                   deadline=deadline, **search_args)
+            for m in steps :
+                if self.cancelled(job_no) :
+                    return 'cancelled', {}
+                moves.append(m)
+                self.events.send((job_no, 'progress', {'move' : m}))
+                if time.time() > deadline :
+                    break
+            if self.cancelled(job_no) :
+                return 'cancelled', {}
+            check = Cube.from_state(state.copy())
+            check.move(moves)
+            solved = bool(check.is_solved())
+            distance = 0.0 if solved else float(check.estimate_distance())
+            return 'done', {'solved' : solved, 'moves' : moves if solved else [], 'best_path' : moves,
+                            'distance' : distance, 'elapsed' : time.time() - tic}
+
+        # mcts: search in slices of progress_interval, reporting progress between them
+        iterations = options.get('iterations')
+        max_nodes = options.get('max_nodes')
+        done_iterations = 0
+        nodes = 0
+        while True :
+            result = mcts.mcts_search(root, None if iterations is None else iterations - done_iterations,
+                                      table=table, pool=pool,
+                                      max_nodes=None if max_nodes is None else max_nodes - nodes,
+                                      deadline=min(deadline, time.time() + self.progress_interval),
+                                      **search_args)
+            done_iterations += result.iterations
+            nodes += result.nodes
+            if self.cancelled(job_no) :
+                return 'cancelled', {}
+            if (result.solved or result.iterations == 0 or time.time() > deadline
+                or (iterations is not None and done_iterations >= iterations)
+                or (max_nodes is not None and nodes >= max_nodes)) :
+                break
+            self.events.send((job_no, 'progress', {'iterations' : done_iterations, 'nodes' : nodes,
+                                                  'distance' : result.distance, 'best_path' : result.best_path}))
+        return 'done', {'solved' : result.solved, 'moves' : result.moves, 'best_path' : result.best_path,
+                        'distance' : result.distance, 'iterations' : done_iterations, 'nodes' : nodes,
+                        'elapsed' : time.time() - tic}
+
+#%% Requests
+
+def parse_request(request) :
+    """
+    Check a request and return (state (54 uint8), engine, options, time_limit).
+    Raises ValueError with a message for the client.
+    """
+    if 'scramble' in request :
+        moves = request['scramble']
+        if isinstance(moves, str) :
+            moves = moves.split()
+        if any(m not in VALID_ROTATES for m in moves) :
+            raise ValueError(f"Invalid rotation in scramble, valid rotations are {' '.join(VALID_ROTATES)}")
+        cube = Cube()
+        cube.move(list(moves))
+        state = cube.cube.reshape(54).astype(np.uint8)
+    elif 'facelets' in request :
+        state = np.array(request['facelets']).reshape(-1)
+        if len(state) != 54 or (np.bincount(state, minlength=6) != 9).any() or state.max() > 5 :
+            raise ValueError("facelets must be 54 colours 0-5, 9 of each")
+        state = state.astype(np.uint8)
+    else :
+        raise ValueError("Request needs a scramble or facelets")
+    engine = request.get('engine', 'mcts')
+    if engine not in ENGINES :
+        raise ValueError(f"engine must be one of {', '.join(ENGINES)}")
+    options = {k : SEARCH_OPTIONS[k](request[k]) for k in SEARCH_OPTIONS if k in request}
+    time_limit = float(request.get('time_limit', 60))
+    return state, engine, options, time_limit
+
+class Job :
+    """
+    A request in the service: the events queue is read by the client connection.
+    """
+    def __init__(self, job_no, request_id, state, engine, options, deadline) :
+        self.job_no = job_no
+        self.request_id = request_id
+        self.state = state
+        self.engine = engine
+        self.options = options
+        self.deadline = deadline
+        self.events = asyncio.Queue()
+        self.solver = None # index of the solver process running it
+        self.finished = False
+
+    def put(self, status, payload={}) :
+        self.events.put_nowait(dict(id=self.request_id, status=status, **payload))
+        if status in ('done', 'cancelled', 'error') :
+            self.finished = True
+
+#%% Service
+
+class SolverService :
+    """
+    Queue of requests, fanned out to n_solvers SolverProcesses with n_workers rollout workers each.
+    Use in a running event loop:
+        service = SolverService()
+        await service.start()
+        job = service.submit({'scramble' : 'R1 U2 F3'})
+        async for event in service.events(job) : ...
+        await service.close()
+    """
+
+    def __init__(self, n_solvers=2, n_workers=4, progress_interval=1.0, pattern_db=None) :
+        self.n_solvers = n_solvers
+        self.n_workers = n_workers
+        self.progress_interval = progress_interval
+        self.pattern_db = pattern_db
+        self.jobs = {} # job_no -> Job, until finished
+        self.next_no = 0
+
+    async def start(self) :
+        self.loop = asyncio.get_running_loop()
+        self.pending = asyncio.Queue()
+        self.idle = asyncio.Queue()
+        self.closing = False
+        self.cancel_flags = [mp.Value('q', -1, lock=False) for _ in range(self.n_solvers)]
+        self.solvers = [None] * self.n_solvers
+        self.job_queues = [None] * self.n_solvers
+        self.event_conns = [None] * self.n_solvers
+        self.running = [None] * self.n_solvers # job_no on each solver
+        self.restarting = {} # solver -> True if it goes back to idle when restarted
+        for i in range(self.n_solvers) :
+            self.job_queues[i], self.event_conns[i], self.solvers[i] = \
+                await self.loop.run_in_executor(None, self.new_solver, i)
+            self.idle.put_nowait(i)
+        # the solver pipes are read in a thread, so the event loop never waits on them
+        self.reader = threading.Thread(target=self.read_events, daemon=True)
+        self.reader.start()
+        self.dispatcher = asyncio.create_task(self.dispatch())
+
+    def new_solver(self, i) :
+        # start a process for solver i, each solver sends its events on its own pipe
+        # Returns (job queue, events pipe, process).  Blocks, so called in an executor.
+        reader, sender = mp.Pipe(duplex=False)
+        jobs = mp.Queue()
+        solver = SolverProcess(jobs, sender, self.cancel_flags[i], self.n_workers, self.progress_interval,
+                               self.pattern_db)
+        solver.start()
+        sender.close()
+        return jobs, reader, solver
+
+    async def close(self) :
+        self.closing = True
+        self.dispatcher.cancel()
+        for job in list(self.jobs.values()) :
+            self.cancel(job)
+        for q in self.job_queues :
+            q.put(None)
+        await self.loop.run_in_executor(None, self.join_solvers)
+        await self.loop.run_in_executor(None, self.reader.join)
+
+    def join_solvers(self, timeout=10) :
+        for s in self.solvers :
+            s.join(timeout)
+            if s.is_alive() :
+                s.terminate()
+                s.join()
+
+    def read_events(self) :
+        """
+        Thread: pass the events of the solvers to the event loop, and tell it when a solver exits.
+        A solver that exits while the service is running has died (e.g. killed out of memory).
+        """
+        exited = set()
+        while not self.closing :
+            watch = {}
+            for i, (solver, conn) in enumerate(zip(self.solvers, self.event_conns)) :
+                if solver not in exited :
+                    watch[conn] = watch[solver.sentinel] = (i, solver)
+            # events before exits, so the last events of a solver are not lost
+            for w in sorted(mp.connection.wait(list(watch), timeout=0.5), key=lambda w : isinstance(w, int)) :
+                i, solver = watch[w]
+                if isinstance(w, int) :
+                    exited.add(solver)
+                    self.loop.call_soon_threadsafe(self.on_solver_exit, i, solver)
+                    continue
+                try :
+                    event = w.recv()
+                except (EOFError, OSError) :
+                    continue # the sentinel shows the exit
+                self.loop.call_soon_threadsafe(self.on_event, i, *event)
+
+    def on_event(self, i, job_no, status, payload) :
+        if status in ('done', 'cancelled', 'error') and self.running[i] == job_no :
+            self.running[i] = None
+            self.idle.put_nowait(i)
+        job = self.jobs.get(job_no)
+        if job is None :
+            return
+        if status in ('done', 'cancelled', 'error') :
+            del self.jobs[job_no]
+        job.put(status, payload)
+
+    def on_solver_exit(self, i, solver) :
+        if self.closing :
+            return
+        job_no = self.running[i]
+        if job_no is not None :
+            self.running[i] = None
+            job = self.jobs.pop(job_no, None)
+            if job is not None :
+                job.put('error', {'error' : f'solver process exited with code {solver.exitcode}'})
+        # an idle solver is already in the idle queue, dispatch skips it until it is restarted
+        self.restarting[i] = job_no is not None
+        asyncio.create_task(self.restart_solver(i, solver))
+
+    async def restart_solver(self, i, solver) :
+        await self.loop.run_in_executor(None, solver.join)
+        new = await self.loop.run_in_executor(None, self.new_solver, i)
+        if self.closing :
+            new[0].put(None)
+            await self.loop.run_in_executor(None, new[2].join)
+            return
+        self.job_queues[i], self.event_conns[i], self.solvers[i] = new
+        if self.restarting.pop(i) :
+            self.idle.put_nowait(i)
+
+    def submit(self, request) :
+        """
+        Queue a request (a dict as in the module docstring).  Returns its Job,
+        or raises ValueError for a bad request.
+        """
+        state, engine, options, time_limit = parse_request(request)
+        job = Job(self.next_no, request.get('id', str(self.next_no)), state, engine, options,
+                  time.time() + time_limit)
+        self.next_no += 1
+        self.jobs[job.job_no] = job
+        self.pending.put_nowait(job)
+        job.put('queued')
+        return job
+
+    def cancel(self, job) :
+        if job.finished :
+            return
+        if job.solver is None : # still queued
+            del self.jobs[job.job_no]
+            job.put('cancelled')
+        else :
+            self.cancel_flags[job.solver].value = job.job_no
+
+    async def dispatch(self) :
+        while True :
+            job = await self.pending.get()
+            if job.finished :
+                continue
+            solver = await self.idle.get()
+            while solver in self.restarting :
+                self.restarting[solver] = True # put back in idle when it is restarted
+                solver = await self.idle.get()
+            if job.finished : # cancelled while waiting for a solver
+                self.idle.put_nowait(solver)
+                continue
+            if time.time() > job.deadline :
+                del self.jobs[job.job_no]
+                self.idle.put_nowait(solver)
+                job.put('done', {'solved' : False, 'moves' : [], 'best_path' : [], 'distance' : None,
+                                 'error' : 'time limit reached in the queue'})
+                continue
+            job.solver = solver
+            self.running[solver] = job.job_no
+            self.job_queues[solver].put((job.job_no, job.state, job.engine, job.options, job.deadline))
+
+    async def events(self, job) :
+        # the events of a job, up to and including the final one
+        while True :
+            event = await job.events.get()
+            yield event
+            if job.finished and job.events.empty() :
+                break
+
+    def status(self) :
+        return {'queued' : self.pending.qsize(), 'jobs' : len(self.jobs),
+                'solvers' : self.n_solvers, 'idle' : self.idle.qsize()}
+
+#%% Front ends
+
+async def write_line(writer, event) :
+    writer.write((json.dumps(event) + '\n').encode())
+    await writer.drain()
+
+async def handle_jsonl(service : SolverService, reader, writer) :
+    """
+    JSON lines connection: many requests, replies interleaved as they come.
+    """
+    jobs = {} # request id -> Job
+    tasks = set()
+
+    async def stream(job) :
+        try :
+            async for event in service.events(job) :
+                await write_line(writer, event)
+        except (ConnectionError, asyncio.CancelledError) :
+            service.cancel(job)
+
+    try :
+        while line := await reader.readline() :
+            request = None
+            try :
+                request = json.loads(line)
+                if 'cancel' in request :
+                    job = jobs.get(request['cancel'])
+                    if job is not None :
+                        service.cancel(job)
+                    continue
+                job = service.submit(request)
+            except (ValueError, TypeError, AttributeError) as e :
+                request_id = request.get('id') if isinstance(request, dict) else None
+                await write_line(writer, {'id' : request_id, 'status' : 'error', 'error' : str(e)})
+                continue
+            jobs[job.request_id] = job
+            task = asyncio.create_task(stream(job))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except (ConnectionError, asyncio.CancelledError) :
+        pass # disconnected, or the server is shutting down
+    finally :
+        for job in jobs.values() :
+            service.cancel(job)
+        for task in tasks :
+            task.cancel()
+        if tasks :
+            await asyncio.gather(*tasks, return_exceptions=True)
+        writer.close()
+
+async def handle_http(service : SolverService, reader, writer) :
+    """
+    Minimal HTTP/1.1: POST /solve streams the replies of 1 request, GET /status.
+    """
+    async def respond(code, reason, body=None, content_type='application/json') :
+        writer.write(f'HTTP/1.1 {code} {reason}\r\nContent-Type: {content_type}\r\nConnection: close\r\n\r\n'.encode())
+        if body is not None :
+            writer.write((json.dumps(body) + '\n').encode())
+        await writer.drain()
+
+    job = None
+    try :
+        request_line = (await reader.readline()).decode().split()
+        headers = {}
+        while (line := await reader.readline()) not in (b'\r\n', b'\n', b'') :
+            name, _, value = line.decode().partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if len(request_line) < 2 :
+            await respond(400, 'Bad Request', {'error' : 'bad request line'})
+        elif request_line[:2] == ['GET', '/status'] :
+            await respond(200, 'OK', service.status())
+        elif request_line[:2] == ['POST', '/solve'] :
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            try :
+                job = service.submit(json.loads(body))
+            except (ValueError, TypeError) as e :
+                await respond(400, 'Bad Request', {'error' : str(e)})
+            else :
+                # the client sends nothing more, so EOF means it has gone: cancel without
+                # waiting for the next event to fail to write
+                watcher = asyncio.create_task(reader.read())
+                watcher.add_done_callback(lambda _ : service.cancel(job))
+                try :
+                    await respond(200, 'OK', content_type='application/x-ndjson')
+                    async for event in service.events(job) :
+                        await write_line(writer, event)
+                finally :
+                    watcher.cancel()
+        else :
+            await respond(404, 'Not Found', {'error' : 'use POST /solve or GET /status'})
+    except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError) :
+        pass
+    finally :
+        if job is not None :
+            service.cancel(job)
+        writer.close()
+
+async def serve(host='127.0.0.1', port=8765, http_port=None, **service_args) :
+    service = SolverService(**service_args)
+    await service.start()
+    servers = [await asyncio.start_server(lambda r, w : handle_jsonl(service, r, w), host, port)]
+    if http_port is not None :
+        servers.append(await asyncio.start_server(lambda r, w : handle_http(service, r, w), host, http_port))
+    print(f'Solver service on {host}:{port} (JSON lines)' +
+          (f' and {host}:{http_port} (HTTP)' if http_port is not None else ''))
+    try :
+        await asyncio.gather(*(s.serve_forever() for s in servers))
+    finally :
+        for s in servers :
+            s.close()
+        await service.close()
+
+#%% Main
+
+if __name__ == '__main__'  :
+    parser = argparse.ArgumentParser(description='Cube solver service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765, help='JSON lines port')
+    parser.add_argument('--http-port', type=int, default=None, help='HTTP port (off by default)')
+    parser.add_argument('--solvers', type=int, default=2, help='searches run at the same time')
+    parser.add_argument('--workers', type=int, default=4, help='rollout workers per solver')
+    parser.add_argument('--pattern-db', default=None, help='pattern database directory, see pattern_db.py')
+    args = parser.parse_args()
+    pattern_db = None
+    if args.pattern_db is not None :
+        import pattern_db as pdb
+        pattern_db = pdb.PatternDatabase(directory=args.pattern_db)
+    try :
+        asyncio.run(serve(args.host, args.port, args.http_port, n_solvers=args.solvers,
+                          n_workers=args.workers, pattern_db=pattern_db))
+    except KeyboardInterrupt :
+        pass
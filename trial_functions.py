@@ -6,6 +6,14 @@ Created on Mon Jan 20 18:36:05 2025
 @author: william
 """
 
+import numpy as np
+from cube import Cube, CubieCube, CubeBatch, VALID_ROTATES, _slice_rotate, compose_moves, \
+    state_key, symmetric_states, canonical_state, align_entropy, ROTATE_TABLE, rotation_code
+import mcts
+import pattern_db
+import ida_star
+import tempfile
+
 def vector_cube(cube) :
     """ returns some kind of vector representation of cube
     with each row = a face and each col = colour 1 or 0
@@ -51,4 +59,370 @@ def compress_moves(in_move) :
         if rotates % 4 != 0 :
             out_move.append(face + str(rotates % 4))
 
-    return out_move
\ No newline at end of file
+    return out_move
+
+
+def test_rotate_tables(n_samples=200, k=20) :
+    """
+    Check the permutation-table rotations against the slice-based reference.
+    Each sample is a random sequence of k rotations, applied one rotation at a time,
+    as a single composed move, and with the slice implementation.
+    """
+    cube = Cube()
+    # every rotation of the solved cube, and quarter turns have order 4
+    for r in VALID_ROTATES :
+        cube.reset()
+        cube.rotate(r)
+        ref = _slice_rotate(np.copy(cube.solved_cube), r)
+        assert (cube.cube == ref).all(), r
+        assert (compose_moves([r[0]+'1']*4) == np.arange(54)).all(), r
+
+    for n in range(n_samples) :
+        cube.reset()
+        move = cube.rand_move(k)
+        ref = np.copy(cube.solved_cube)
+        for r in move :
+            cube.rotate(r)
+            _slice_rotate(ref, r)
+        assert (cube.cube == ref).all(), move
+
+        cube.reset()
+        cube.move(move)
+        assert (cube.cube == ref).all(), move
+    return True
+
+
+def test_cubie_cube(n_samples=200, k=20) :
+    """
+    Check that facelet -> cubie -> facelet is lossless, that cubie rotations
+    match facelet rotations, and that the integer key round-trips.
+    """
+    cube = Cube()
+    for n in range(n_samples) :
+        cube.reset()
+        move = cube.rand_move(k)
+        cube.move(move)
+        cubie = CubieCube.from_cube(cube)
+        assert (cubie.to_facelets() == cube.cube).all(), move
+        
+        moved = CubieCube()
+        moved.move(move)
+        assert moved == cubie, move
+        assert CubieCube.from_key(cubie.to_key()) == cubie, move
+    return True
+
+
+def test_symmetries(n_samples=50, k=12) :
+    """
+    Symmetric images of a 1-rotation state are 1-rotation states, 
+    and every image of a state has the same canonical state.
+    """
+    one_rotation = {state_key(Cube().child(r).cube) for r in VALID_ROTATES}
+    for r in VALID_ROTATES :
+        for image in symmetric_states(Cube().child(r).cube)[0] :
+            assert state_key(image) in one_rotation, r
+
+    cube = Cube()
+    for n in range(n_samples) :
+        cube.reset()
+        cube.move(cube.rand_move(k))
+        images = symmetric_states(cube.cube)[0]
+        canon, sym = canonical_state(images)
+        assert (canon == canon[0]).all()
+        assert canon[0].tobytes() == min(i.tobytes() for i in images)
+    return True
+
+
+def test_cube_batch(n_samples=50, k=12) :
+    """
+    Check CubeBatch against 1 Cube at a time: a different rotation per row,
+    all children of a state with from_moves, and the rewards of every row.
+    """
+    cubes = []
+    for n in range(n_samples) :
+        cube = Cube()
+        cube.move(cube.rand_move(k))
+        cubes.append(cube)
+    batch = CubeBatch.from_cubes(cubes)
+    rotations = [VALID_ROTATES[np.random.randint(len(VALID_ROTATES))] for _ in cubes]
+    batch.rotate(rotations)
+    for cube, r in zip(cubes, rotations) :
+        cube.rotate(r)
+    for cube, state in zip(cubes, batch.to_cubes()) :
+        assert (state.cube == cube.cube).all()
+    assert np.allclose(batch.get_reward(), [cube.get_reward() for cube in cubes])
+
+    moves = [cubes[0].rand_move(3) for _ in range(n_samples)]
+    children = CubeBatch.from_moves(cubes[0].cube, moves)
+    rewards = []
+    for move, state in zip(moves, children.to_cubes()) :
+        child = Cube.from_state(cubes[0].cube.copy())
+        child.move(move)
+        assert (state.cube == child.cube).all(), move
+        rewards.append(child.get_reward())
+    assert np.allclose(children.get_reward(), rewards)
+    return True
+
+
+def align_entropy_reference(cube) :
+    # The original if-statement version of Cube.align_entropy, kept to check the table driven one
+    # A measure based on alignment of corners and edges, which is always a step towards solved state.
+    # range: 8 - 32
+    max_entropy = 8*4
+    align = 0
+
+    UFL = (cube[0,2,0], cube[2,0,0], cube[1,0,2]) 
+    URF = (cube[0,2,2], cube[3,0,0], cube[2,0,2]) 
+    ULB = (cube[0,0,0], cube[1,0,0], cube[4,0,2])
+    UBR = (cube[0,0,2], cube[4,0,0], cube[3,0,2])
+    DLF = (cube[5,0,0], cube[1,2,2], cube[2,2,0])
+    DFR = (cube[5,0,2], cube[2,2,2], cube[3,2,0])
+    DLB = (cube[5,2,0], cube[1,2,0], cube[4,2,2])
+    DBR = (cube[5,2,2], cube[4,2,0], cube[3,2,2])
+
+    UF = (cube[0,2,1], cube[2,0,1]) 
+    UL = (cube[0,1,0], cube[1,0,1]) 
+    UB = (cube[0,0,1], cube[4,0,1]) 
+    UR = (cube[0,1,2], cube[3,0,1]) 
+
+    LF = (cube[1,1,2], cube[2,1,0]) 
+    LB = (cube[1,1,0], cube[4,1,2]) 
+    RF = (cube[3,1,0], cube[2,1,2]) 
+    BR = (cube[4,1,0], cube[3,1,2]) 
+
+    DF = (cube[5,0,1], cube[2,2,1]) 
+    DL = (cube[5,1,0], cube[1,2,1]) 
+    DB = (cube[5,2,1], cube[4,2,1]) 
+    DR = (cube[5,1,2], cube[3,2,1]) 
+
+    U = cube[0,1,1]
+    L = cube[1,1,1]
+    F = cube[2,1,1]
+    R = cube[3,1,1]
+    B = cube[4,1,1]
+    D = cube[5,1,1]
+
+    # UFL should align with UF, LF, UL
+    # UFL should align with U, F, L
+    if UFL[0] == UF[0] and UFL[1] == UF[1] :
+        align += 1
+    if UFL[2] == LF[0] and UFL[1] == LF[1] :
+        align += 1
+    if UFL[0] == UL[0] and UFL[2] == UL[1] :
+        align += 1
+    if UFL[0] == U and UFL[1] == F :
+        align += 1
+
+    # URF should align with UR, RF, UF
+    # URF should align with U, R, L
+    if URF[0] == UR[0] and URF[1] == UR[1] :
+        align += 1
+    if URF[1] == RF[0] and URF[2] == RF[1] :
+        align += 1
+    if URF[0] == UF[0] and URF[2] == UF[1] :
+        align += 1
+    if URF[0] == U and URF[1] == R :
+        align += 1
+
+    # ULB should align with UL, LB, UB
+    # ULB should align with U, L, B
+    if ULB[0] == UL[0] and ULB[1] == UL[1] :
+        align += 1
+    if ULB[1] == LB[0] and ULB[2] == LB[1] :
+        align += 1
+    if ULB[0] == UB[0] and ULB[2] == UB[1] :
+        align += 1
+    if ULB[0] == U and ULB[1] == L :
+        align += 1
+
+    # UBR should align with UB, BR, UR
+    # UBR should align with U, B, R
+    if UBR[0] == UB[0] and UBR[1] == UB[1] :
+        align += 1
+    if UBR[1] == BR[0] and UBR[2] == BR[1] :
+        align += 1
+    if UBR[0] == UR[0] and UBR[2] == UR[1] :
+        align += 1
+    if UBR[0] == U and UBR[1] == B :
+        align += 1
+
+    # DLF should align with DL, LF, DF
+    if DLF[0] == DL[0] and DLF[1] == DL[1] :
+        align += 1
+    if DLF[1] == LF[0] and DLF[2] == LF[1] :
+        align += 1
+    if DLF[0] == DF[0] and DLF[2] == DF[1] :
+        align += 1
+    if DLF[0] == D and DLF[1] == L :
+        align += 1
+
+    # DFR should align with DF, RF, DR
+    if DFR[0] == DF[0] and DFR[1] == DF[1] :
+        align += 1
+    if DFR[1] == RF[1] and DFR[2] == RF[0] :
+        align += 1
+    if DFR[0] == DR[0] and DFR[2] == DR[1] :
+        align += 1
+    if DFR[0] == D and DFR[1] == F :
+        align += 1
+
+    # DLB should align with DL, LB, DB
+    if DLB[0] == DL[0] and DLB[1] == DL[1] :
+        align += 1
+    if DLB[1] == LB[0] and DLB[2] == LB[1] :
+        align += 1
+    if DLB[0] == DB[0] and DLB[2] == DB[1] :
+        align += 1
+    if DLB[0] == D and DLB[1] == L :
+        align += 1
+
+    # DBR should align with DB, BR, DR
+    if DBR[0] == DB[0] and DBR[1] == DB[1] :
+        align += 1
+    if DBR[1] == BR[0] and DBR[2] == BR[1] :
+        align += 1
+    if DBR[0] == DR[0] and DBR[2] == DR[1] :
+        align += 1
+    if DBR[0] == D and DBR[1] == B :
+        align += 1
+
+    return max_entropy - align
+
+
+def test_align_entropy(n_samples=500, k=20) :
+    """
+    Check the table driven align_entropy against the original if statements,
+    on single states and on the whole batch.
+    """
+    cube = Cube()
+    states = []
+    for n in range(n_samples) :
+        cube.reset()
+        cube.move(cube.rand_move(np.random.randint(k+1)))
+        states.append(cube.cube.reshape(54).copy())
+        assert align_entropy(states[-1]) == align_entropy_reference(cube.cube), cube.moves
+    batch = align_entropy(np.stack(states))
+    assert (batch == [align_entropy(s) for s in states]).all()
+    return True
+
+
+def check_tree(root, table=None) :
+    """
+    Walk the tree (or DAG) below root and check its links: children[i] is the state after
+    possible_actions[i], every child lists the node as a parent, and no child is an ancestor.
+    With a table, each position is in the tree once and the table maps it to its node.
+    Returns the number of nodes below root.
+    """
+    seen = {id(root) : root}
+    stack = [root]
+    while stack :
+        node = stack.pop()
+        assert not node.children or len(node.children) == len(node.possible_actions)
+        for a, child in zip(node.possible_actions, node.children) :
+            state = node.state.cube.reshape(54)[ROTATE_TABLE[rotation_code(a)]]
+            assert (child.state.cube.reshape(54) == state).all(), a
+            assert any(p is node for p in child.parents()), a
+            assert not node.has_ancestor(child), a
+            if id(child) not in seen :
+                seen[id(child)] = child
+                stack.append(child)
+    if table is not None :
+        keys = {state_key(n.state.cube) : n for n in seen.values()}
+        assert len(keys) == len(seen)
+        assert all(table.nodes.get(key) is n for key, n in keys.items())
+    return len(seen) - 1
+
+
+def test_transpositions(n_samples=6, k=6, iterations=300) :
+    """
+    Search the same scrambles with and without a TranspositionTable.
+    Both trees keep their links and node counts, the table tree has no repeated positions,
+    and every solution found solves the cube.
+    """
+    with mcts.SolverPool(n_workers=2) as pool :
+        for n in range(n_samples) :
+            cube = Cube()
+            scramble = cube.rand_move(k)
+            for table in (None, mcts.TranspositionTable()) :
+                rubiks = Cube()
+                rubiks.move(scramble)
+                root = mcts.TreeHorn(rubiks)
+                result = mcts.mcts_search(root, iterations=iterations, table=table, pool=pool)
+                assert check_tree(root, table) == root.stats.nodes == root.traverse()[1], scramble
+                if result.solved :
+                    rubiks.move(result.moves)
+                    assert rubiks.is_solved(), (scramble, result.moves)
+    return True
+
+
+# patterns small enough to build in under a second
+SMALL_PATTERNS = (pattern_db.Pattern('corners', (0,1,2)), pattern_db.Pattern('edges', (0,1,2)),
+                  pattern_db.Pattern('edges', (8,9,10)))
+
+def test_pattern_db(n_samples=200, k=8) :
+    """
+    Check the pattern database on SMALL_PATTERNS:
+    every index round-trips through decode/encode (also sampled for the default patterns),
+    table moves match facelet moves, and the heuristic is never more than the scramble depth.
+    """
+    for p in SMALL_PATTERNS :
+        idx = np.arange(p.size)
+        assert (p.encode(*p.decode(idx)) == idx).all(), p
+    for p in pattern_db.DEFAULT_PATTERNS :
+        idx = np.random.randint(p.size, size=10000)
+        assert (p.encode(*p.decode(idx)) == idx).all(), p
+
+    cube = Cube()
+    states = []
+    for n in range(n_samples) :
+        cube.reset()
+        cube.move(cube.rand_move(k))
+        states.append(cube.cube.reshape(54).copy())
+    states = np.stack(states)
+    for p in SMALL_PATTERNS + pattern_db.DEFAULT_PATTERNS :
+        pos, ori = p.decode(p.index_states(states))
+        for m, r in enumerate(VALID_ROTATES) :
+            moved = p.encode(*p.apply(pos, ori, m))
+            assert (moved == p.index_states(states[:, ROTATE_TABLE[m]])).all(), (p, r)
+
+    with tempfile.TemporaryDirectory() as directory :
+        pattern_db.build(SMALL_PATTERNS, directory, verbose=False)
+        db = pattern_db.PatternDatabase(SMALL_PATTERNS, directory)
+        assert (db.heuristic(Cube().cube) == 0).all()
+        for n in range(n_samples) :
+            cube.reset()
+            depth = np.random.randint(1, k+1)
+            cube.move(cube.rand_move(depth))
+            assert db.heuristic(cube.cube) <= depth, cube.moves
+    return True
+
+
+def test_engines(scrambles=(4,5,6), samples=3, iterations=1000) :
+    """
+    Solve the same cubes with mcts_search and ida_search, as evaluate.compare_engines.
+    Every solution found must solve the cube.  IDA* must solve all of them, and with
+    the (admissible) SMALL_PATTERNS database in no more rotations than the scramble.
+    """
+    with tempfile.TemporaryDirectory() as directory, mcts.SolverPool(n_workers=2) as pool :
+        pattern_db.build(SMALL_PATTERNS, directory, verbose=False)
+        db = pattern_db.PatternDatabase(SMALL_PATTERNS, directory)
+        for s in scrambles :
+            for n in range(samples) :
+                rubiks = Cube()
+                scramble = rubiks.rand_move(s)
+                rubiks.move(scramble)
+                result = mcts.mcts_search(mcts.TreeHorn(rubiks), iterations=iterations, pool=pool)
+                solutions = [result.moves] if result.solved else []
+
+                solved, moves = ida_star.ida_search(rubiks)
+                assert solved, scramble
+                solutions.append(moves)
+                solved, moves = ida_star.ida_search(rubiks, pattern_db=db)
+                assert solved and len(moves) <= s, (scramble, moves)
+                solutions.append(moves)
+
+                for moves in solutions :
+                    cube = Cube.from_state(rubiks.cube.copy())
+                    cube.move(moves)
+                    assert cube.is_solved(), (scramble, moves)
+    return True